@@ -2,33 +2,83 @@
 
 import pygame
 import logging
+import sys
 import traceback
-from logging.handlers import RotatingFileHandler
-from typing import Tuple, List
+from logging.handlers import QueueListener
+from threading import Lock
+from typing import Tuple, List, Optional
 
 from hackerspaces import HackerSpace, HackerSpacesNL
 from hackerspaces_renderer import HackerSpacesRenderer
 from gpio import FirmataGPIO, LampColor
+from spaceapi import SpaceApiFederation, merge_spaces
 from spacestate import SpaceState, HackerHotelStateApi
-from state_animation import StateAnimationRenderer
+from state_animation import StateAnimationRenderer, Assets
+from logsetup import setup_logging
+from startup import StartupSequence
+from memory_watchdog import MemoryWatchdog
 
-# empirical approximations to match the geo coordinates to the map
-NL_CENTER: Tuple[float, float] = (5.24791, 52.1372954)
-NL_SCALE: Tuple[float, float] = (3.85422677912357, 4.353798024388546)
+# also show the spaces listed in the SpaceAPI directory
+FEDERATE_SPACEAPI: bool = True
 
 
 class App:
     def __init__(self) -> None:
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format='%(asctime)s - %(levelname)s - %(module)s:%(funcName)s - %(message)s',
-            handlers=[
-                RotatingFileHandler('./logs/hotelstate.log', maxBytes=100000, backupCount=10),
-                logging.StreamHandler()
-            ]
-        )
+        self.log_listener: QueueListener = setup_logging()
+
+        self.watchdog: MemoryWatchdog = MemoryWatchdog()
+        self.watchdog.register('surfaces', lambda: Assets().surface_bytes())
+        self.watchdog.register('sounds', lambda: Assets().sound_bytes())
+        self.watchdog.register('map', lambda: self.hsnl_renderer.surface_bytes() if self.hsnl_renderer else 0)
+        self.watchdog.register('hsnl', self._spaces_bytes)
+        self.watchdog.start()
+
+        self.startup: StartupSequence = StartupSequence()
+        self.startup.measure('display', self._init_display)
+
+        self.clock: pygame.time.Clock = pygame.time.Clock()
+
+        self.state: SpaceState = SpaceState.UNDETERMINED  # data from FirmataGPIO
+        # the first state FirmataGPIO reports is the state the switch was left
+        # in, e.g. before a power cut; it is not a flip of the switch
+        self.state_known: bool = False
+        self.spaces: List[HackerSpace] = []  # merged data from HackerSpacesNL and SpaceApiFederation
+        self.hsnl_spaces: List[HackerSpace] = []
+        self.federated_spaces: List[HackerSpace] = []
+        # spaces are merged and handed to the map from several threads; without
+        # a lock an older merge can reach the map last
+        self.spaces_lock: Lock = Lock()
+
+        self.space_api: HackerHotelStateApi = HackerHotelStateApi(self._handle_state_posted)
+
+        # subsystems are filled in by the startup sequence as they become ready
+        self.open_sfx: Optional[pygame.mixer.Sound] = None
+        self.close_sfx: Optional[pygame.mixer.Sound] = None
+        self.gpio: Optional[FirmataGPIO] = None
+        self.hsnl: Optional[HackerSpacesNL] = None
+        self.federation: Optional[SpaceApiFederation] = None
+        self.hsnl_renderer: Optional[HackerSpacesRenderer] = None
+        self.animation_renderer: Optional[StateAnimationRenderer] = None
+
+        self.exit_app: bool = False
+        self.show_spark: bool = False
 
-        pygame.init()
+        self.startup.add('sounds', self._load_sounds, self._on_sounds_ready)
+        self.startup.add('gpio', lambda: FirmataGPIO(self._handle_gpio_state), self._on_gpio_ready)
+        self.startup.add('hsnl', lambda: HackerSpacesNL(self._handle_hackerspaces_update), self._on_hsnl_ready)
+        if FEDERATE_SPACEAPI:
+            self.startup.add('spaceapi', lambda: SpaceApiFederation(self._handle_federation_update), self._on_federation_ready)
+        self.startup.add('map', HackerSpacesRenderer, self._on_map_ready)
+        # animations load sounds, so they need the mixer from the sounds step
+        self.startup.add('animations', StateAnimationRenderer, self._on_animations_ready, ['sounds'])
+        self.startup.start()
+
+    def _spaces_bytes(self) -> int:
+        spaces: List[HackerSpace] = self.hsnl_spaces + self.federated_spaces + self.spaces
+        return sum(sys.getsizeof(space) + sys.getsizeof(space.name) for space in spaces)
+
+    def _init_display(self) -> None:
+        pygame.display.init()
         pygame.mouse.set_visible(False)
         self.screen_width: int = 1080
         self.screen_height: int = 1920
@@ -38,28 +88,39 @@ class App:
         )
         pygame.display.set_caption('HotelSwitch')
 
-        self.clock: pygame.time.Clock = pygame.time.Clock()
-
-        self.open_sfx: pygame.mixer.Sound = pygame.mixer.Sound('data/open.wav')
-        self.close_sfx: pygame.mixer.Sound = pygame.mixer.Sound('data/close.wav')
-
-        self.state: SpaceState = SpaceState.UNDETERMINED  # data from FirmataGPIO
-        self.spaces: List[HackerSpace] = []  # data from HackerSpacesNL
+        # show the logo as the first frame, while the rest is starting up
+        self.logo: pygame.Surface = pygame.image.load("data/logo.png")
+        self.screen.fill((0,0,0))
+        self.screen.blit(self.logo, (0, self.screen_height - self.logo.get_height()))
+        pygame.display.flip()
 
-        self.space_api: HackerHotelStateApi = HackerHotelStateApi()
+    def _load_sounds(self) -> Tuple[pygame.mixer.Sound, pygame.mixer.Sound]:
+        pygame.mixer.init()
+        return pygame.mixer.Sound('data/open.wav'), pygame.mixer.Sound('data/close.wav')
 
-        self.gpio: FirmataGPIO = FirmataGPIO(self._handle_gpio_state)
-        self.hsnl: HackerSpacesNL = HackerSpacesNL(self._handle_hackerspaces_update)
+    def _on_sounds_ready(self, sounds: Tuple[pygame.mixer.Sound, pygame.mixer.Sound]) -> None:
+        self.open_sfx, self.close_sfx = sounds
 
-        self.hsnl_renderer: HackerSpacesRenderer = HackerSpacesRenderer()
-        self.animation_renderer: StateAnimationRenderer = StateAnimationRenderer(self.gpio)
+    def _on_gpio_ready(self, gpio: FirmataGPIO) -> None:
+        self.gpio = gpio
+        if self.animation_renderer is not None:
+            self.animation_renderer.set_gpio(gpio)
+        self._update_lamps()
 
-        self.logo: pygame.Surface = pygame.image.load("data/logo.png")
+    def _on_hsnl_ready(self, hsnl: HackerSpacesNL) -> None:
+        self.hsnl = hsnl
 
-        self.exit_app: bool = False
-        self.show_spark: bool = False
+    def _on_federation_ready(self, federation: SpaceApiFederation) -> None:
+        self.federation = federation
 
+    def _on_map_ready(self, renderer: HackerSpacesRenderer) -> None:
+        self.hsnl_renderer = renderer
+        self._merge_spaces()
 
+    def _on_animations_ready(self, renderer: StateAnimationRenderer) -> None:
+        self.animation_renderer = renderer
+        self.animation_renderer.set_gpio(self.gpio)
+        self.animation_renderer.set_state(self.state, animate=False)
 
     def _handle_events(self) -> None:
         for event in pygame.event.get():
@@ -75,42 +136,78 @@ class App:
 
 
     def _handle_gpio_state(self, state: SpaceState) -> None:
-        if hasattr(self, 'animation_renderer') and state != self.state:
-            self.animation_renderer.set_state(state)
+        if self.animation_renderer is not None and state != self.state:
+            self.animation_renderer.set_state(state, animate=self.state_known)
         self.state = state
+        self.state_known = True
 
         logging.info(f'Hacker Hotel state: {state.name}')
 
         self.show_spark = True
 
-        if state == SpaceState.UNDETERMINED:
-            self.open_sfx.play()
-        else:
-            self.close_sfx.play()
+        if self.open_sfx is not None and self.close_sfx is not None:
+            if state == SpaceState.UNDETERMINED:
+                self.open_sfx.play()
+            else:
+                self.close_sfx.play()
+
+        self._update_lamps()
+
+        self.space_api.set_state(state)
+
+        with self.spaces_lock:
+            if self.hsnl_renderer is not None:
+                self.hsnl_renderer.update(self.spaces, self.state)
+
+    def _update_lamps(self) -> None:
+        if self.gpio is None:
+            return
 
         # update relays via GPIO
-        if state == SpaceState.OPEN:
+        if self.state == SpaceState.OPEN:
             self.gpio.set_color(LampColor.GREEN)
-        elif state == SpaceState.UNDETERMINED:
+        elif self.state == SpaceState.UNDETERMINED:
             self.gpio.set_color(LampColor.ORANGE)
-        elif state == SpaceState.CLOSED:
+        elif self.state == SpaceState.CLOSED:
             self.gpio.set_color(LampColor.RED)
 
-        self.space_api.set_state(state)
 
-        self.hsnl_renderer.update(self.spaces, self.state)
+    def _handle_state_posted(self, state: SpaceState) -> None:
+        # the hsnl map includes our own state; pick up the change right away
+        if self.hsnl is not None:
+            self.hsnl.refresh()
 
 
     def _handle_hackerspaces_update(self, spaces: List[HackerSpace]) -> None:
-        self.spaces = spaces
-        self.hsnl_renderer.update(self.spaces, self.state)
+        self.hsnl_spaces = spaces
+        self._merge_spaces()
+
+    def _handle_federation_update(self, spaces: List[HackerSpace]) -> None:
+        self.federated_spaces = spaces
+        self._merge_spaces()
+
+    def _merge_spaces(self) -> None:
+        with self.spaces_lock:
+            # the directory lists spaces all over the world, most of them off the map
+            federated_spaces: List[HackerSpace] = []
+            if self.hsnl_renderer is not None:
+                federated_spaces = self.hsnl_renderer.visible_spaces(self.federated_spaces)
+
+            # hackerspaces.nl takes priority over the SpaceAPI directory
+            self.spaces = merge_spaces([self.hsnl_spaces, federated_spaces])
+            if self.hsnl_renderer is not None:
+                self.hsnl_renderer.update(self.spaces, self.state)
 
 
     def update(self) -> None:
         self._handle_events()
-        hotel_coordinates = self.hsnl_renderer.get_hotel_coordinates()
-        if hotel_coordinates:
-            self.animation_renderer.set_hotel_coordinates(hotel_coordinates)
+        if not self.startup.is_done():
+            self.startup.poll()
+
+        if self.hsnl_renderer is None or self.animation_renderer is None:
+            return
+        # highlight the Hacker Hotel marker in the color of the lamps
+        self.hsnl_renderer.set_hotel_color(self.animation_renderer.get_state_color())
 
 
     def draw(self) -> None:
@@ -120,9 +217,11 @@ class App:
             return
 
         self.screen.fill((0,0,0))
-        self.hsnl_renderer.draw(self.screen)
+        if self.hsnl_renderer is not None:
+            self.hsnl_renderer.draw(self.screen)
         self.screen.blit(self.logo, (0, self.screen_height - self.logo.get_height()))
-        self.animation_renderer.draw(self.screen)
+        if self.animation_renderer is not None:
+            self.animation_renderer.draw(self.screen)
 
 
     def run(self) -> None:
@@ -138,9 +237,15 @@ class App:
         except Exception:
             traceback.print_exc()
 
-        # cleanup
-        self.gpio.close()
-        self.hsnl.stop()
+        # cleanup; steps that are still starting up are daemon threads
+        if self.gpio is not None:
+            self.gpio.close()
+        if self.hsnl is not None:
+            self.hsnl.stop()
+        if self.federation is not None:
+            self.federation.stop()
+        self.watchdog.stop()
+        self.log_listener.stop()
 
 
 if __name__ == '__main__':
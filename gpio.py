@@ -1,19 +1,32 @@
-import pyfirmata2
+import heapq
 import logging
+import os
 import time
 
 from enum import Enum
-from threading import Timer
+from threading import Condition, Event, RLock, Thread, current_thread
 
-from typing import Dict, Callable, Optional
+from typing import Dict, Callable, List, Optional, Tuple, TYPE_CHECKING
 
 from debounce import debounce
 
 from spacestate import SpaceState
 
-DEVICE = pyfirmata2.Arduino.AUTODETECT
+if TYPE_CHECKING:
+    import pyfirmata2
+
+DEVICE: Optional[str] = None  # None: autodetect
 #DEVICE = '/dev/ttyUSB0'
 
+# the last port a board was found on; tried before DEVICE on the next connect
+PORT_CACHE_FILE: str = './cache/firmata_port'
+
+RECONNECT_MIN_DELAY: float = 0.1  # seconds
+RECONNECT_MAX_DELAY: float = 10  # seconds
+HEALTH_CHECK_PERIOD: float = 0.25  # seconds
+
+CONFETTI_DURATION: float = 2  # seconds
+
 
 class ArduinoPin(Enum):
     RELAY_VCC = 13
@@ -39,17 +52,183 @@ class LampColor(Enum):
     GREEN = (0, 255, 0)
 
 
-# fix an uncaught exception in pyfirmata2.Arduino.__del__
-pyfirmata2_del = pyfirmata2.Arduino.__del__
-def pyfirmata2_del_fix(self):
+def _import_pyfirmata2():
+    """
+        Imports pyfirmata2 (and pyserial) on first use rather than when this
+        module is imported, so it does not add to the time until the first frame.
+    """
+    import pyfirmata2
+
+    if not hasattr(pyfirmata2.Pin, 'unregister_callback'):
+        # fix uncaught exceptions in pyfirmata2.Arduino.__del__, which writes
+        # to the port; that fails when setup failed or the board is unplugged
+        pyfirmata2_del = pyfirmata2.Arduino.__del__
+        def pyfirmata2_del_fix(self):
+            try:
+                pyfirmata2_del(self)
+            except Exception:
+                pass
+        pyfirmata2.Arduino.__del__ = pyfirmata2_del_fix
+
+        # fix a typo in pyfirmata2.Pin
+        pyfirmata2.Pin.unregister_callback = pyfirmata2.Pin.unregiser_callback
+
+    return pyfirmata2
+
+
+def _load_cached_port() -> Optional[str]:
     try:
-        pyfirmata2_del(self)
-    except AttributeError:
-        pass
-pyfirmata2.Arduino.__del__ = pyfirmata2_del_fix
+        with open(PORT_CACHE_FILE) as port_file:
+            return port_file.read().strip() or None
+    except OSError:
+        return None
 
-# fix a typo in pyfirmata2.Pin
-pyfirmata2.Pin.unregister_callback = pyfirmata2.Pin.unregiser_callback
+
+def _save_cached_port(port: str) -> None:
+    if port == _load_cached_port():
+        return
+    try:
+        os.makedirs(os.path.dirname(PORT_CACHE_FILE), exist_ok=True)
+        with open(PORT_CACHE_FILE, 'w') as port_file:
+            port_file.write(port)
+    except OSError as e:
+        logging.warning(f'Failed to cache board port: {e}')
+
+
+RELAY_PINS = [
+    ArduinoPin.RED1, ArduinoPin.ORANGE1, ArduinoPin.GREEN1,
+    ArduinoPin.RED2, ArduinoPin.ORANGE2, ArduinoPin.GREEN2,
+    ArduinoPin.CONFETTI, ArduinoPin.UNUSED
+]
+LAMP_PINS = [
+    ArduinoPin.RED1, ArduinoPin.ORANGE1, ArduinoPin.GREEN1,
+    ArduinoPin.RED2, ArduinoPin.ORANGE2, ArduinoPin.GREEN2
+]
+
+
+class _BoardSupervisor(Thread):
+    """
+        Keeps the board connected: connects in the background, checks the link
+        while connected and reconnects with exponential backoff when it drops.
+    """
+    def __init__(self, gpio: 'FirmataGPIO') -> None:
+        super().__init__(name='board-supervisor', daemon=True)
+        self._gpio: 'FirmataGPIO' = gpio
+
+        self._wake_event: Event = Event()
+        self._stop_event: Event = Event()
+
+    def run(self) -> None:
+        delay: float = RECONNECT_MIN_DELAY
+        while not self._stop_event.is_set():
+            if self._gpio.is_connected():
+                if not self._gpio._is_alive():
+                    logging.warning('Lost connection to board')
+                    self._gpio._disconnect()
+                    continue
+                delay = RECONNECT_MIN_DELAY
+                timeout: float = HEALTH_CHECK_PERIOD
+            elif self._gpio._connect():
+                delay = RECONNECT_MIN_DELAY
+                continue
+            else:
+                timeout = delay
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+            self._wake_event.wait(timeout)
+            self._wake_event.clear()
+
+    def wake(self) -> None:
+        self._wake_event.set()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake_event.set()
+
+
+class _OutputWorker(Thread):
+    """
+        The only thread that writes relays. Changes are merged into the
+        desired relay state, so a burst of changes results in a single write
+        of the latest state, and only relays that differ from what is on the
+        board are written. Changes can be scheduled for a point in time; they
+        are written early by the measured write latency, so they land on time.
+    """
+    def __init__(self, gpio: 'FirmataGPIO') -> None:
+        super().__init__(name='gpio-output', daemon=True)
+        self._gpio: 'FirmataGPIO' = gpio
+
+        self._condition: Condition = Condition()
+        # (time, sequence number, changes); the sequence number keeps the order
+        # of changes scheduled for the same time
+        self._schedule: List[Tuple[float, int, Dict[ArduinoPin, bool]]] = []
+        self._sequence: int = 0
+        self._dirty: bool = False
+        self._stopped: bool = False
+
+        self.write_latency: float = 0.005  # seconds; updated with every write
+
+    def submit(self, changes: Dict[ArduinoPin, bool], at: Optional[float] = None) -> None:
+        with self._condition:
+            if at is None:
+                self._gpio._relay_state.update(changes)
+                self._dirty = True
+            else:
+                self._sequence += 1
+                heapq.heappush(self._schedule, (at, self._sequence, changes))
+            self._condition.notify()
+
+    def clear_schedule(self, pins: List[ArduinoPin]) -> None:
+        """ Drops the scheduled changes to `pins`. """
+        with self._condition:
+            schedule = []
+            for at, sequence, changes in self._schedule:
+                changes = {pin: state for pin, state in changes.items() if pin not in pins}
+                if changes:
+                    schedule.append((at, sequence, changes))
+            heapq.heapify(schedule)
+            self._schedule = schedule
+
+    def resync(self) -> None:
+        """ Writes the desired state again, e.g. after the board reconnected. """
+        with self._condition:
+            self._dirty = True
+            self._condition.notify()
+
+    def snapshot(self) -> Dict[ArduinoPin, bool]:
+        with self._condition:
+            return dict(self._gpio._relay_state)
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    now: float = time.monotonic()
+                    while self._schedule and self._schedule[0][0] - self.write_latency <= now:
+                        _, _, changes = heapq.heappop(self._schedule)
+                        self._gpio._relay_state.update(changes)
+                        self._dirty = True
+
+                    if self._dirty:
+                        self._dirty = False
+                        desired: Dict[ArduinoPin, bool] = dict(self._gpio._relay_state)
+                        break
+                    if self._stopped:
+                        return
+
+                    timeout: Optional[float] = None
+                    if self._schedule:
+                        timeout = self._schedule[0][0] - self.write_latency - now
+                    self._condition.wait(timeout)
+
+            start_time: float = time.monotonic()
+            if self._gpio._write_relays(desired):
+                self.write_latency = 0.8 * self.write_latency + 0.2 * (time.monotonic() - start_time)
 
 
 class FirmataGPIO:
@@ -58,68 +237,222 @@ class FirmataGPIO:
 
         self.state: Optional[SpaceState] = None
 
-        self._confetti_timer: Optional[Timer] = None
+        self._confetti_until: float = 0
 
-        self._board: Optional[pyfirmata2.Arduino] = None
-        logging.info('Connecting to board...')
-        try:
-            self._board = pyfirmata2.Arduino(DEVICE)
-        except Exception as e:
-            logging.error(f'Failed to connect to device: {e}')
-            return
+        # the relay states we want, kept while disconnected and re-sent on
+        # reconnect, and the states last written to the board; both are only
+        # changed by the output worker
+        self._relay_state: Dict[ArduinoPin, bool] = {pin_id: False for pin_id in RELAY_PINS}
+        self._written_state: Dict[ArduinoPin, bool] = {}
 
-        logging.info('Setting up inputs...')
-        self._board.samplingOn(100)
-        self._inputs: Dict[ArduinoPin, pyfirmata2.Pin] = {}
-        for pin_id in [ArduinoPin.SWITCH_TOP, ArduinoPin.SWITCH_BOTTOM]:
-            self._inputs[pin_id] = self._board.get_pin('d:%d:i' % pin_id.value)
-            self._inputs[pin_id].register_callback(
-                self._handle_gpio_input
-            )
-            self._inputs[pin_id].enable_reporting()
-
-        logging.info('Setting up outputs...')
-
-        # prepare relay board
-        self._relay_vcc: pyfirmata2.Pin = self._board.get_pin('d:%d:o' % ArduinoPin.RELAY_VCC.value)
-        self._relay_vcc.write(False)
-
-        self._relays: Dict[ArduinoPin, pyfirmata2.Pin] = {}
-        for pin_id in [
-            ArduinoPin.RED1, ArduinoPin.ORANGE1, ArduinoPin.GREEN1,
-            ArduinoPin.RED2, ArduinoPin.ORANGE2, ArduinoPin.GREEN2,
-            ArduinoPin.CONFETTI, ArduinoPin.UNUSED
-        ]:
-            self._relays[pin_id] = self._board.get_pin('d:%d:o' % pin_id.value)
-            self.set_relay(pin_id, False)
-
-        # enable relays
-        self._relay_vcc.write(True)
+        self._board_lock: RLock = RLock()
+        self._board: Optional['pyfirmata2.Arduino'] = None
+        self._inputs: Dict[ArduinoPin, 'pyfirmata2.Pin'] = {}
+        self._relays: Dict[ArduinoPin, 'pyfirmata2.Pin'] = {}
+        self._relay_vcc: Optional['pyfirmata2.Pin'] = None
+        self._connect_failures: int = 0
 
-        self._update_switch_state()
+        self._output: _OutputWorker = _OutputWorker(self)
+        self._output.start()
 
-    def close(self) -> None:
-        if self._board is None:
-            return
+        self._supervisor: _BoardSupervisor = _BoardSupervisor(self)
+        self._supervisor.start()
 
-        logging.info('Closing GPIO...')
+    def is_connected(self) -> bool:
+        return self._board is not None
 
-        for input in self._inputs.values():
-            input.disable_reporting()
-            input.unregister_callback()
-
-        for relay in self._relays.keys():
-            self.set_relay(relay, False)
-        self._relay_vcc.write(0)
-
-        self._board.exit()
-        self._board = None
-
-    def set_relay(self, pin: ArduinoPin, state: bool) -> None:
-        if self._board is None or pin not in self._relays:
+    def close(self) -> None:
+        self._supervisor.stop()
+        self._supervisor.join()
+
+        # switch off all relays, and wait for that to be written
+        self._output.clear_schedule(RELAY_PINS)
+        self._output.submit({relay: False for relay in RELAY_PINS})
+        self._output.stop()
+        self._output.join()
+
+        with self._board_lock:
+            if self._board is None:
+                return
+
+            logging.info('Closing GPIO...')
+
+            try:
+                for input in self._inputs.values():
+                    input.disable_reporting()
+                    input.unregister_callback()
+
+                self._relay_vcc.write(0)
+            except Exception as e:
+                logging.error(f'Failed to reset board: {e}')
+
+        self._disconnect()
+
+    def _connect(self) -> bool:
+        """
+            Tries the last port that worked before falling back to DEVICE, sets
+            up the board and restores the relay state. Called from the
+            supervisor thread; the board lock is only held once the serial
+            connection is open.
+        """
+        ports: List[Optional[str]] = []
+        cached_port: Optional[str] = _load_cached_port()
+        if cached_port is not None and (not cached_port.startswith('/dev/') or os.path.exists(cached_port)):
+            ports.append(cached_port)
+        if DEVICE not in ports:
+            ports.append(DEVICE)
+
+        for port in ports:
+            if self._connect_failures == 0:
+                logging.info(f'Connecting to board on {port or "autodetected port"}...')
+            board: Optional['pyfirmata2.Arduino'] = None
+            try:
+                pyfirmata2 = _import_pyfirmata2()
+                board = pyfirmata2.Arduino(port)
+                self._setup_board(board)
+            except Exception as e:
+                if self._connect_failures == 0:
+                    logging.error(f'Failed to connect to device: {e}')
+                else:
+                    logging.debug(f'Failed to connect to device: {e}')
+                if board is not None:
+                    try:
+                        board.exit()
+                    except Exception:
+                        pass
+                continue
+
+            self._connect_failures = 0
+            _save_cached_port(board.sp.port)
+            logging.info(f'Connected to board on {board.sp.port}')
+
+            # the switch may have been moved while we were disconnected
+            self._update_switch_state()
+            return True
+
+        self._connect_failures += 1
+        return False
+
+    def _setup_board(self, board: 'pyfirmata2.Arduino') -> None:
+        with self._board_lock:
+            logging.info('Setting up inputs...')
+            board.samplingOn(100)
+            inputs: Dict[ArduinoPin, 'pyfirmata2.Pin'] = {}
+            for pin_id in [ArduinoPin.SWITCH_TOP, ArduinoPin.SWITCH_BOTTOM]:
+                inputs[pin_id] = board.get_pin('d:%d:i' % pin_id.value)
+                inputs[pin_id].register_callback(
+                    self._handle_gpio_input
+                )
+                inputs[pin_id].enable_reporting()
+
+            logging.info('Setting up outputs...')
+
+            # prepare relay board
+            relay_vcc: 'pyfirmata2.Pin' = board.get_pin('d:%d:o' % ArduinoPin.RELAY_VCC.value)
+            relay_vcc.write(False)
+
+            # set the relays before powering them, so they do not flicker
+            relay_state: Dict[ArduinoPin, bool] = self._output.snapshot()
+            relays: Dict[ArduinoPin, 'pyfirmata2.Pin'] = {}
+            for pin_id in RELAY_PINS:
+                relays[pin_id] = board.get_pin('d:%d:o' % pin_id.value)
+                relays[pin_id].write(not relay_state[pin_id])  # NB: relays are active low
+
+            # enable relays
+            relay_vcc.write(True)
+
+            self._inputs = inputs
+            self._relays = relays
+            self._relay_vcc = relay_vcc
+            self._written_state = relay_state
+            self._board = board
+
+        # in case the desired state changed during the setup
+        self._output.resync()
+
+    def _disconnect(self) -> None:
+        with self._board_lock:
+            board = self._board
+            self._board = None
+            self._inputs = {}
+            self._relays = {}
+            self._relay_vcc = None
+            self._written_state = {}
+
+        if board is None:
             return
-
-        self._relays[pin].write(not state)  # NB: relays are active low
+        try:
+            board.exit()
+        except Exception as e:
+            # the port is likely gone already
+            logging.debug(f'Failed to exit board cleanly: {e!r}')
+        finally:
+            # exit() writes to the port before closing it; when that fails the
+            # port stays open, and a replugged board gets a different device
+            sampler = board.samplerThread
+            if sampler is not None:
+                sampler.stop()
+                if sampler.ident is not None and sampler is not current_thread():
+                    sampler.join(1)
+            try:
+                if board.sp is not None:
+                    board.sp.close()
+            except Exception as e:
+                logging.warning(f'Failed to close serial port: {e!r}')
+
+    def _is_alive(self) -> bool:
+        board = self._board
+        if board is None or board.sp is None or not board.sp.is_open:
+            return False
+
+        # pyfirmata2's sampling thread quietly ends on a serial error
+        sampler = board.samplerThread
+        if sampler is not None and sampler.ident is not None and not sampler.is_alive():
+            return False
+
+        # a usb serial device node disappears when the board is unplugged
+        port: str = board.sp.port
+        if port and port.startswith('/dev/') and not os.path.exists(port):
+            return False
+
+        return True
+
+    def set_relay(self, pin: ArduinoPin, state: bool, at: Optional[float] = None) -> None:
+        """
+            Sets a relay, right away or at time `at` (in time.monotonic()
+            seconds). Never waits for the board; the output worker does the writing.
+        """
+        if pin not in self._relay_state:
+            return
+        self._output.submit({pin: state}, at)
+
+    def clear_schedule(self) -> None:
+        """
+            Cancels lamp changes scheduled for later. Confetti shots that were
+            scheduled still go off, and are still switched off in time.
+        """
+        self._output.clear_schedule(LAMP_PINS)
+
+    def _write_relays(self, relay_state: Dict[ArduinoPin, bool]) -> bool:
+        """ Writes the relays that differ from the board. Called by the output worker. """
+        with self._board_lock:
+            if self._board is None:
+                return False
+            try:
+                for pin, state in relay_state.items():
+                    if self._written_state.get(pin) != state:
+                        self._relays[pin].write(not state)  # NB: relays are active low
+                        self._written_state[pin] = state
+            except Exception as e:
+                logging.error(f'Failed to write to board: {e}')
+                failed = True
+            else:
+                failed = False
+
+        if failed:
+            self._disconnect()
+            self._supervisor.wake()
+        return not failed
 
     def _handle_gpio_input(self, data) -> None:
         self._update_switch_state()
@@ -128,13 +461,16 @@ class FirmataGPIO:
     def _update_switch_state(self) -> None:
         last_state: SpaceState = self.state
 
-        top_switch_value = not self._inputs[ArduinoPin.SWITCH_TOP].value
-        bottom_switch_value = not self._inputs[ArduinoPin.SWITCH_BOTTOM].value
-
-        if self._board is None:
+        inputs: Dict[ArduinoPin, 'pyfirmata2.Pin'] = self._inputs
+        if self._board is None or not inputs:
+            # keep the last known state; it is read again once the board reconnects
             logging.warning('Board is not connected')
-            self.state = SpaceState.UNDETERMINED
-        elif top_switch_value and bottom_switch_value:
+            return
+
+        top_switch_value = not inputs[ArduinoPin.SWITCH_TOP].value
+        bottom_switch_value = not inputs[ArduinoPin.SWITCH_BOTTOM].value
+
+        if top_switch_value and bottom_switch_value:
             logging.warning('Both open and closed contacts are connected. Weird...')
             self.state = SpaceState.UNDETERMINED
         elif top_switch_value:
@@ -150,35 +486,29 @@ class FirmataGPIO:
         if self.state != last_state and self.on_state_changed is not None:
             self.on_state_changed(self.state)
 
-    def set_color(self, color: LampColor) -> None:
+    def set_color(self, color: LampColor, at: Optional[float] = None) -> None:
         red: bool = True if color==LampColor.RED or color==LampColor.YELLOW else False
         orange: bool = True if color==LampColor.ORANGE or color==LampColor.YELLOW else False
         green: bool = True if color==LampColor.GREEN or color==LampColor.YELLOW else False
 
-        self.set_relay(ArduinoPin.RED1, red)
-        self.set_relay(ArduinoPin.RED2, red)
-        self.set_relay(ArduinoPin.ORANGE1, orange)
-        self.set_relay(ArduinoPin.ORANGE2, orange)
-        self.set_relay(ArduinoPin.GREEN1, green)
-        self.set_relay(ArduinoPin.GREEN2, green)
-
-    def fire_confetti(self) -> None:
-        if self._confetti_timer is not None:
+        self._output.submit({
+            ArduinoPin.RED1: red,
+            ArduinoPin.RED2: red,
+            ArduinoPin.ORANGE1: orange,
+            ArduinoPin.ORANGE2: orange,
+            ArduinoPin.GREEN1: green,
+            ArduinoPin.GREEN2: green,
+        }, at)
+
+    def fire_confetti(self, at: Optional[float] = None) -> None:
+        start_time: float = at if at is not None else time.monotonic()
+        if start_time < self._confetti_until:
             return
 
         logging.info('Firing confetti canons')
-        self._confetti_timer = Timer(
-            2, self._reset_confetti
-        )
-        self._confetti_timer.start()
-        self.set_relay(ArduinoPin.CONFETTI, True)
-
-    def _reset_confetti(self) -> None:
-        logging.debug('Resetting confetti canon relays')
-
-        self._confetti_timer = None
-        self.set_relay(ArduinoPin.CONFETTI, False)
-
+        self._confetti_until = start_time + CONFETTI_DURATION
+        self.set_relay(ArduinoPin.CONFETTI, True, at)
+        self.set_relay(ArduinoPin.CONFETTI, False, self._confetti_until)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,23 @@
-import requests
 from threading import Thread, Lock, Event
 import logging
 import copy
+import json
+import os
 import time
-from typing import List, Dict, Any, Optional, Callable
+from typing import List, Dict, Any, Optional, Callable, Mapping
 
+from scheduler import AdaptivePollScheduler
 from spacestate import SpaceState
 
 GEOJSON_URL: str = 'https://hackerspaces.nl/hsmap/hsnl.geojson'
+# the refresh period adapts between the min and max period to how often the data changes
 REFRESH_PERIOD: int = 60  # seconds
+MIN_REFRESH_PERIOD: int = 30  # seconds
+MAX_REFRESH_PERIOD: int = 600  # seconds
+FETCH_TIMEOUT: float = 10  # seconds
+
+# the last successfully parsed list of spaces, shown until the first fetch completes
+CACHE_FILE: str = './cache/hsnl_spaces.json'
 
 # default HackerHotel entry
 HH_NAME: str = 'Hacker Hotel'
@@ -16,7 +25,15 @@ HH_LATITUDE: float = 52.2208671
 HH_LONGITUDE: float = 5.7208085
 
 
+MARKER_STATES: Dict[str, SpaceState] = {
+    '/hsmap/hs_open.png': SpaceState.OPEN,
+    '/hsmap/hs_closed.png': SpaceState.CLOSED,
+}
+
+
 class HackerSpace:
+    __slots__ = ('name', 'lat', 'lon', 'state')
+
     def __init__(self, name: str, lat: float, lon: float, state: SpaceState):
         self.name: str = name
         self.lat: float = lat
@@ -32,33 +49,57 @@ class _GetDataThread(Thread):
 
         self._data_event: Event = Event()
         self._data_lock: Lock = Lock()
-        self._stop_event: Event = Event()
-        self._last_refresh: float = 0
+        self.scheduler: AdaptivePollScheduler = AdaptivePollScheduler(
+            REFRESH_PERIOD, MIN_REFRESH_PERIOD, MAX_REFRESH_PERIOD
+        )
 
         self._data: Dict[str, Any] = {}
 
     def run(self) -> None:
-        while not self._stop_event.is_set():
-            current_time: float = time.monotonic()
-            if current_time - self._last_refresh > REFRESH_PERIOD:
-                logging.info('Refreshing hsnl geojson data')
-
+        import requests  # imported here to keep it off the startup path
+
+        last_content: Optional[bytes] = None
+        etag: Optional[str] = None
+        while self.scheduler.wait():
+            logging.info('Refreshing hsnl geojson data')
+
+            # on any error, keep the data we have
+            data: Optional[Dict[str, Any]] = None
+            headers: Optional[Mapping[str, str]] = None
+            try:
+                response = requests.get(
+                    GEOJSON_URL,
+                    headers={'If-None-Match': etag} if etag else None,
+                    timeout=FETCH_TIMEOUT
+                )
+                headers = response.headers
+                if response.status_code != 304:
+                    response.raise_for_status()
+                    content: bytes = response.content
+                    if content != last_content:
+                        data = json.loads(content)
+                        last_content = content
+                    etag = response.headers.get('ETag')
+            except Exception as e:
+                logging.error(f'Error fetching hsnl geojson data: {e}')
+
+            self.scheduler.record(data is not None, headers)
+
+            if data is not None:
                 with self._data_lock:
-                    try:
-                        self._data = requests.get(GEOJSON_URL).json()
-                    except Exception as e:
-                        logging.error('Error fetching hsnl geojson data')
-                        self._data.clear()
-                self._last_refresh: float = time.monotonic()
-                self._data_event.set()
-
-                if self._on_data_received is not None:
-                    self._on_data_received(copy.deepcopy(self._data))
+                    self._data = data
+            self._data_event.set()
 
-            time.sleep(0.5)
+            if data is not None and self._on_data_received is not None:
+                # the dict is replaced rather than modified, so it can be shared
+                self._on_data_received(data)
 
     def stop(self) -> None:
-        self._stop_event.set()
+        logging.info(
+            f'Stopping hsnl refreshes after {self.scheduler.requests} requests; '
+            f'{self.scheduler.requests_saved()} saved compared to polling every {REFRESH_PERIOD}s'
+        )
+        self.scheduler.stop()
 
     def has_data(self) -> None:
         if(self._data_event.is_set()):
@@ -75,24 +116,39 @@ class _GetDataThread(Thread):
 class HackerSpacesNL:
     def __init__(self, on_spaces_changed: Optional[Callable[[List[HackerSpace]], None]] = None) -> None:
         self._on_spaces_changed: Optional[Callable[[List[HackerSpace]], None]] = on_spaces_changed
-        self.spaces: List[HackerSpace] = []
+        self.spaces: List[HackerSpace] = _load_cache()
 
-        self._data_thread = _GetDataThread(self.on_data_received)
-        self._data_thread.start()
+        if self.spaces and self._on_spaces_changed is not None:
+            self._on_spaces_changed(self.spaces)
 
         self._data: Dict[str, Any] = {}
 
+        self._data_thread = _GetDataThread(self.on_data_received)
+        self._data_thread.start()
+
     def stop(self) -> None:
         logging.debug('Stopping hsnl updates')
         self._data_thread.stop()
         self._data_thread.join()
 
+    def refresh(self, delay: float = 0) -> None:
+        """ Refreshes the data `delay` seconds from now, instead of when it is due. """
+        self._data_thread.scheduler.wake(delay)
+
     def on_data_received(self, data: Dict[str, Any]):
-        if data == self._data:
+        if data is self._data:
             return
         self._data = data
 
-        self._process(data)
+        spaces: List[HackerSpace] = self._process(data)
+        if len(spaces) <= 1:
+            # nothing but the manually added Hacker Hotel; keep what we have
+            logging.warning('No spaces found in hsnl geojson data; keeping previous data')
+            return
+
+        # the list is replaced rather than modified, so it can be shared with the renderer
+        self.spaces = spaces
+        _save_cache(spaces)
 
         if self._on_spaces_changed != None:
             self._on_spaces_changed(self.spaces)
@@ -120,42 +176,92 @@ class HackerSpacesNL:
 
         self.on_data_received(data)
 
-    def _process(self, data: Dict[str, Any]):
+    def _process(self, data: Dict[str, Any]) -> List[HackerSpace]:
         """
             Processes the geojson data received from the Hackerspaces.nl API.
-            The result populates self.spaces: List[HackerSpaces]
+            Only the name, coordinates and marker symbol of each feature are read.
 
             Args:
                 data (json): The geojson data returned from the API
-        """
-        self.spaces.clear()
 
-        includes_hackerhotel: bool = False
-
-        if 'features' in data:
-            for feature in data['features']:
-                try:
-                    name: str = feature['properties']['name']
-                    lat: float = float(feature['geometry']['coordinates'][1])
-                    lon: float = float(feature['geometry']['coordinates'][0])
-
-                    state: SpaceState = SpaceState.UNDETERMINED
-                    if feature['properties']['marker-symbol'] == '/hsmap/hs_open.png':
-                        state = SpaceState.OPEN
-                    elif feature['properties']['marker-symbol'] == '/hsmap/hs_closed.png':
-                        state = SpaceState.CLOSED
+            Returns:
+                List[HackerSpace]: The spaces, always including the Hacker Hotel
+        """
+        start_time: float = time.perf_counter()
 
-                    if name == HH_NAME:
-                        includes_hackerhotel: bool = True
+        spaces: List[HackerSpace] = []
+        append = spaces.append
+        undetermined: SpaceState = SpaceState.UNDETERMINED
+        marker_states = MARKER_STATES
 
-                    self.spaces.append(HackerSpace(name, lat, lon, state))
-                except Exception as e:
-                    logging.error(f'Error parsing feature: {feature}', e)
+        includes_hackerhotel: bool = False
+        features: List[Dict[str, Any]] = data.get('features', []) if isinstance(data, dict) else []
+        skipped: int = 0
+
+        for feature in features:
+            try:
+                properties = feature['properties']
+                coordinates = feature['geometry']['coordinates']
+                name: str = properties['name']
+                append(HackerSpace(
+                    name,
+                    float(coordinates[1]),
+                    float(coordinates[0]),
+                    marker_states.get(properties.get('marker-symbol'), undetermined)
+                ))
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                logging.debug(f'Skipping feature: {e!r}')
+                skipped += 1
+                continue
+
+            if name == HH_NAME:
+                includes_hackerhotel = True
 
         if not includes_hackerhotel:
             logging.info('Hacker Hotel not found in geojson data; adding manually')
 
-            self.spaces.append(HackerSpace(HH_NAME, HH_LATITUDE, HH_LONGITUDE, SpaceState.UNDETERMINED))
+            spaces.append(HackerSpace(HH_NAME, HH_LATITUDE, HH_LONGITUDE, SpaceState.UNDETERMINED))
+
+        logging.info(
+            f'Parsed {len(features)} features into {len(spaces)} spaces '
+            f'({skipped} skipped) in {(time.perf_counter() - start_time) * 1000:.1f} ms'
+        )
+
+        return spaces
+
+
+def _load_cache() -> List[HackerSpace]:
+    start_time: float = time.perf_counter()
+    try:
+        with open(CACHE_FILE) as cache_file:
+            spaces: List[HackerSpace] = [
+                HackerSpace(name, lat, lon, SpaceState(state))
+                for name, lat, lon, state in json.load(cache_file)
+            ]
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        logging.warning(f'Ignoring unreadable hsnl cache: {e}')
+        return []
+
+    logging.info(
+        f'Loaded {len(spaces)} cached spaces in {(time.perf_counter() - start_time) * 1000:.1f} ms'
+    )
+    return spaces
+
+
+def _save_cache(spaces: List[HackerSpace]) -> None:
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        temp_file: str = CACHE_FILE + '.tmp'
+        with open(temp_file, 'w') as cache_file:
+            json.dump(
+                [(space.name, space.lat, space.lon, space.state.value) for space in spaces],
+                cache_file, separators=(',', ':')
+            )
+        os.replace(temp_file, CACHE_FILE)
+    except OSError as e:
+        logging.warning(f'Failed to write hsnl cache: {e}')
 
 
 if __name__ == '__main__':
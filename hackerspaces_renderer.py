@@ -1,44 +1,171 @@
 import pygame
-from typing import List, Tuple, Optional
+import math
+import time
+from threading import Lock
+from typing import Dict, List, Tuple, Optional
 
 from hackerspaces import HackerSpace, HH_NAME
+from projection import MapProjection, HSNL_MAP_FILE, HSNL_PROJECTION
 from spacestate import SpaceState
 from gpio import LampColor
+from memory_watchdog import surface_bytes
 
+MARKER_RADIUS: int = 8
+HOTEL_MARKER_RADIUS: int = 16
 
-# empirical approximations to match the geo coordinates to the map
-NL_CENTER: Tuple[float, float] = (5.24791, 52.1372954)
-NL_SCALE: Tuple[float, float] = (3.854227, 2.449011)
+# markers fade to their new color when a space opens or closes, while pulsing
+# up to (1 + MARKER_PULSE) times their size
+MARKER_ANIMATION_DURATION: float = 1.5  # seconds
+MARKER_PULSE: float = 0.75
+
+# ring around the Hacker Hotel marker while the lamps are lit
+HOTEL_RING_RADIUS: int = HOTEL_MARKER_RADIUS + 8
+HOTEL_RING_WIDTH: int = 3
+
+
+class _MarkerTile:
+    """
+        A marker that is drawn separately from the rest of the map. `patch` is
+        the map underneath the marker tile, so the marker can be redrawn
+        without redrawing the map.
+    """
+    __slots__ = ('position', 'radius', 'from_color', 'to_color', 'start', 'rect', 'patch')
+
+    def __init__(
+            self, position: Tuple[int, int], radius: int,
+            from_color: Tuple[int, int, int], to_color: Tuple[int, int, int],
+            start: float, extent: int
+        ) -> None:
+        self.position: Tuple[int, int] = position
+        self.radius: int = radius
+        self.from_color: Tuple[int, int, int] = from_color
+        self.to_color: Tuple[int, int, int] = to_color
+        self.start: float = start
+        self.rect: pygame.Rect = pygame.Rect(position[0] - extent, position[1] - extent, extent * 2 + 1, extent * 2 + 1)
+        self.patch: Optional[pygame.Surface] = None
+
+    def capture(self, surface: pygame.Surface) -> None:
+        self.rect = self.rect.clip(surface.get_rect())
+        self.patch = surface.subsurface(self.rect).copy() if self.rect.width and self.rect.height else None
+
+    def restore(self, surface: pygame.Surface) -> None:
+        if self.patch is not None:
+            surface.blit(self.patch, self.rect)
+
+    def color_at(self, progress: float) -> Tuple[int, int, int]:
+        return tuple(
+            int(a + (b - a) * progress) for a, b in zip(self.from_color, self.to_color)
+        )
 
 
 class HackerSpacesRenderer():
-    def __init__(self):
-        self._background_image: pygame.Surface = pygame.image.load('data/hsnl.png')
+    def __init__(
+            self,
+            map_file: str = HSNL_MAP_FILE,
+            projection: MapProjection = HSNL_PROJECTION,
+            viewport: Optional[Tuple[int, int, int, int]] = None,
+            size: Optional[Tuple[int, int]] = None
+        ):
+        """
+            Args:
+                map_file (str): The background map
+                projection (MapProjection): The projection calibrated for the map
+                viewport (rect): The part of the map to show; the whole map if not set
+                size (tuple): The size to render the viewport at; the size of the
+                    viewport if not set
+        """
+        self._map_image: pygame.Surface = pygame.image.load(map_file)
+        self._map_projection: MapProjection = projection
+
+        # scaled crops of the map, by viewport and size
+        self._crops: Dict[Tuple[Tuple[int, int, int, int], Tuple[int, int]], Tuple[pygame.Surface, MapProjection]] = {}
+
+        self._spaces: List[HackerSpace] = []
+        self._hackerhotel_state: SpaceState = SpaceState.UNDETERMINED
+        self._hotel_space_coordinates: Optional[Tuple[int, int]] = None
+
+        # update() may be called from other threads; the map is redrawn in draw()
+        self._pending_lock: Lock = Lock()
+        self._pending: Optional[Tuple[List[HackerSpace], SpaceState]] = None
+
+        self._marker_colors: Dict[str, Tuple[int, int, int]] = {}
+        self._animations: Dict[str, _MarkerTile] = {}
+        self._hotel_tile: Optional[_MarkerTile] = None
+        self._hotel_color: Optional[Tuple[int, int, int]] = None
+        self._drawn_hotel_color: Optional[Tuple[int, int, int]] = None
+        self._hotel_tile_dirty: bool = True
 
-        self._surface:pygame.Surface = self._background_image.copy()
+        self.set_viewport(viewport, size)
+
+    def set_viewport(self, viewport: Optional[Tuple[int, int, int, int]] = None, size: Optional[Tuple[int, int]] = None) -> None:
+        if viewport is None:
+            viewport = (0, 0, self._map_image.get_width(), self._map_image.get_height())
+        if size is None:
+            size = (viewport[2], viewport[3])
+
+        key = (tuple(viewport), tuple(size))
+        if key not in self._crops:
+            crop: pygame.Surface = self._map_image.subsurface(viewport)
+            if size != (viewport[2], viewport[3]):
+                crop = pygame.transform.smoothscale(crop, size)
+            self._crops[key] = (crop, self._map_projection.cropped(viewport, size))
+
+        self._background_image, self._projection = self._crops[key]
+
+        self._surface: pygame.Surface = self._background_image.copy()
         self._surface.fill((0,0,0))
 
         self._surface_width = self._surface.get_width()
         self._surface_height = self._surface.get_height()
 
-        self._hotel_space_coordinates: Optional[Tuple[int, int]] = None
+        # markers are positioned differently in the new viewport
+        self._marker_colors.clear()
+        self._animations.clear()
+        self.update(self._spaces, self._hackerhotel_state)
 
     def update(self, spaces: List[HackerSpace], hackerhotel_state:SpaceState):
+        with self._pending_lock:
+            self._pending = (spaces, hackerhotel_state)
+
+    def visible_spaces(self, spaces: List[HackerSpace]) -> List[HackerSpace]:
+        """ The spaces that are on the part of the map that is shown. """
+        width: int = self._surface_width
+        height: int = self._surface_height
+        visible: List[HackerSpace] = []
+        for space in spaces:
+            x, y = self._projection.project(space.lon, space.lat)
+            if 0 <= x < width and 0 <= y < height:
+                visible.append(space)
+        return visible
+
+    def set_hotel_color(self, color: Optional[Tuple[int, int, int]]) -> None:
+        """ Highlights the Hacker Hotel marker in the color of the lamps, if set. """
+        self._hotel_color = color
+
+    def _redraw(self, spaces: List[HackerSpace], hackerhotel_state:SpaceState):
+        self._spaces = spaces
+        self._hackerhotel_state = hackerhotel_state
+
         self._surface.fill((0, 0, 0))
         self._surface.blit(self._background_image, (0, 0))
 
-        self._hotel_space = None
-        for space in spaces:
-            x: int = (self._surface_width // 2) + int((space.lon - NL_CENTER[0]) / NL_SCALE[0] * self._surface_width)
-            y: int = (self._surface_height // 2) - int((space.lat - NL_CENTER[1]) / NL_SCALE[1] * self._surface_width)
+        # positions are cached per space, so state-only changes do no geo math
+        positions: List[Tuple[int, int]] = self._projection.project_spaces(spaces)
 
-            radius = 8
+        now: float = time.monotonic()
+        marker_colors: Dict[str, Tuple[int, int, int]] = {}
+        animations: Dict[str, _MarkerTile] = {}
+        self._hotel_tile = None
+        self._hotel_space_coordinates = None
+
+        for space, (x, y) in zip(spaces, positions):
+            radius = MARKER_RADIUS
 
             state: SpaceState = space.state
             if space.name == HH_NAME:
                 self._hotel_space_coordinates = (x, y)
                 state = hackerhotel_state
-                radius = 16
+                radius = HOTEL_MARKER_RADIUS
 
             if state == SpaceState.OPEN:
                 color: Tuple[int, int, int] = LampColor.GREEN.value
@@ -47,6 +174,29 @@ class HackerSpacesRenderer():
             else:
                 color: Tuple[int, int, int] = LampColor.ORANGE.value
 
+            marker_colors[space.name] = color
+
+            if space.name == HH_NAME:
+                # drawn as a tile, so it can follow the lamp color
+                self._hotel_tile = _MarkerTile((x, y), radius, color, color, now, HOTEL_RING_RADIUS + 1)
+                continue
+
+            # animate markers that changed color; ongoing animations continue
+            # from the color they had reached
+            previous_color: Optional[Tuple[int, int, int]] = self._marker_colors.get(space.name)
+            animation: Optional[_MarkerTile] = self._animations.get(space.name)
+            if animation is not None and animation.to_color != color:
+                previous_color = animation.color_at(min(1.0, (now - animation.start) / MARKER_ANIMATION_DURATION))
+                animation = None
+            if animation is None and previous_color is not None and previous_color != color:
+                animation = _MarkerTile(
+                    (x, y), radius, previous_color, color, now,
+                    int(math.ceil(radius * (1 + MARKER_PULSE))) + 1
+                )
+            if animation is not None and animation.position == (x, y):
+                animations[space.name] = animation
+                continue
+
             pygame.draw.circle(
                 self._surface,
                 color,
@@ -54,8 +204,99 @@ class HackerSpacesRenderer():
                 radius
             )
 
+        self._marker_colors = marker_colors
+        self._animations = animations
+
+        # grab the map underneath the tiles, then draw the tiles on top
+        for animation in self._animations.values():
+            animation.capture(self._surface)
+        if self._hotel_tile is not None:
+            self._hotel_tile.capture(self._surface)
+        self._hotel_tile_dirty = True
+        self._animate(now)
+
+    def _animate(self, now: float) -> None:
+        """
+            Redraws the marker tiles that changed, on top of their cached map
+            patches. Tiles can overlap, so all patches are restored before any
+            marker is drawn.
+        """
+        hotel_tile: Optional[_MarkerTile] = self._hotel_tile
+        hotel_color: Optional[Tuple[int, int, int]] = self._hotel_color
+        redraw_hotel: bool = hotel_tile is not None and (
+            self._hotel_tile_dirty or hotel_color != self._drawn_hotel_color or
+            any(animation.rect.colliderect(hotel_tile.rect) for animation in self._animations.values())
+        )
+
+        for animation in self._animations.values():
+            animation.restore(self._surface)
+        if redraw_hotel:
+            hotel_tile.restore(self._surface)
+
+        for name, animation in list(self._animations.items()):
+            if now - animation.start >= MARKER_ANIMATION_DURATION:
+                del self._animations[name]
+                self._draw_final_marker(animation)
+
+        for animation in self._animations.values():
+            progress: float = (now - animation.start) / MARKER_ANIMATION_DURATION
+            pygame.draw.circle(
+                self._surface,
+                animation.color_at(progress),
+                animation.position,
+                int(animation.radius * (1 + MARKER_PULSE * math.sin(math.pi * progress)))
+            )
+
+        if redraw_hotel:
+            pygame.draw.circle(
+                self._surface,
+                hotel_color if hotel_color is not None else hotel_tile.to_color,
+                hotel_tile.position,
+                hotel_tile.radius
+            )
+            if hotel_color is not None:
+                pygame.draw.circle(
+                    self._surface, hotel_color, hotel_tile.position, HOTEL_RING_RADIUS, HOTEL_RING_WIDTH
+                )
+            self._drawn_hotel_color = hotel_color
+            self._hotel_tile_dirty = False
+
+    def _draw_final_marker(self, animation: _MarkerTile) -> None:
+        """
+            Draws the marker of a finished animation on the map, and in the
+            patches of the tiles it overlaps, so restoring those keeps it.
+        """
+        pygame.draw.circle(self._surface, animation.to_color, animation.position, animation.radius)
+
+        tiles: List[_MarkerTile] = list(self._animations.values()) + ([self._hotel_tile] if self._hotel_tile else [])
+        for tile in tiles:
+            if tile.patch is not None and tile.rect.colliderect(animation.rect):
+                pygame.draw.circle(
+                    tile.patch, animation.to_color,
+                    (animation.position[0] - tile.rect.x, animation.position[1] - tile.rect.y),
+                    animation.radius
+                )
+
     def draw(self, destination: pygame.Surface, x: int=0, y: int=0):
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = None
+        if pending is not None:
+            self._redraw(*pending)
+        else:
+            self._animate(time.monotonic())
+
         destination.blit(self._surface, (x, y))
 
+    def surface_bytes(self) -> int:
+        """ The memory used by the map, its crops, the rendered map and the marker patches. """
+        tiles: List[_MarkerTile] = list(self._animations.values()) + ([self._hotel_tile] if self._hotel_tile else [])
+        return (
+            surface_bytes(self._map_image) +
+            sum(surface_bytes(crop) for crop, _ in list(self._crops.values())) +
+            surface_bytes(self._surface) +
+            sum(surface_bytes(tile.patch) for tile in tiles if tile.patch is not None)
+        )
+
     def get_hotel_coordinates(self) -> Optional[Tuple[int, int]]:
         return self._hotel_space_coordinates
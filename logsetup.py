@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import queue
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Deque, Dict, Optional, Tuple
+
+LOG_FILE: str = './logs/hotelstate.log'
+LOG_MAX_BYTES: int = 1000000
+LOG_BACKUP_COUNT: int = 10
+
+# records waiting for the writer thread; when the writer falls behind, new
+# records are dropped rather than blocking the thread that logged them
+QUEUE_SIZE: int = 10000
+
+# minimum level per module (the filename of the module that logs, as that is
+# what `logging.info` and friends report when called on the root logger)
+DEFAULT_LEVEL: int = logging.DEBUG
+MODULE_LEVELS: Dict[str, int] = {
+    'gpio': logging.DEBUG,
+    'hackerspaces': logging.INFO,
+    'state_animation': logging.INFO,
+}
+
+# identical messages from the same place are let through at most
+# RATE_LIMIT_BURST times per RATE_LIMIT_PERIOD seconds
+RATE_LIMIT_PERIOD: float = 60
+RATE_LIMIT_BURST: int = 5
+
+# DEBUG records are kept in memory and only written to disk when an error occurs
+RING_BUFFER_SIZE: int = 500
+
+
+class ModuleLevelFilter(logging.Filter):
+    def __init__(self, levels: Dict[str, int], default_level: int = logging.DEBUG) -> None:
+        super().__init__()
+        self._levels: Dict[str, int] = levels
+        self._default_level: int = default_level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self._levels.get(record.module, self._default_level)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+        Suppresses repetitive messages. Once a message has been let through
+        `burst` times within `period` seconds, further copies are dropped until
+        the period ends; the first record after that carries a count of the
+        suppressed copies.
+    """
+    def __init__(self, period: float = RATE_LIMIT_PERIOD, burst: int = RATE_LIMIT_BURST) -> None:
+        super().__init__()
+        self._period: float = period
+        self._burst: int = burst
+        # (module, lineno, msg) -> [period start, count, suppressed]
+        self._seen: Dict[Tuple[str, int, Any], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+
+        key = (record.module, record.lineno, record.msg)
+        now: float = record.created
+        entry = self._seen.get(key)
+        if entry is None or now - entry[0] > self._period:
+            if entry is not None and entry[2]:
+                record.suppressed = entry[2]
+            if len(self._seen) > 1000:
+                self._seen.clear()
+            self._seen[key] = [now, 1, 0]
+            return True
+
+        entry[1] += 1
+        if entry[1] > self._burst:
+            entry[2] += 1
+            return False
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped: int = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge the arguments into the message; formatting (timestamps,
+        # tracebacks, json) is left to the writer thread.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'module': record.module,
+            'func': record.funcName,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RingBufferHandler(logging.Handler):
+    """
+        Keeps the most recent records in memory. When a record at or above
+        `flush_level` comes in, the buffered records are written to `target`,
+        so the context leading up to an error ends up on disk.
+    """
+    def __init__(
+            self, target: logging.Handler,
+            capacity: int = RING_BUFFER_SIZE,
+            flush_level: int = logging.ERROR
+        ) -> None:
+        super().__init__(logging.DEBUG)
+        self._target: logging.Handler = target
+        self._flush_level: int = flush_level
+        self._buffer: Deque[logging.LogRecord] = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.levelno >= self._flush_level:
+            for buffered in self._buffer:
+                self._target.handle(buffered)
+            self._buffer.clear()
+        elif record.levelno < self._target.level:
+            # records the target accepts are already written by the target itself
+            self._buffer.append(record)
+
+
+def setup_logging(
+        filename: str = LOG_FILE,
+        levels: Optional[Dict[str, int]] = None,
+        default_level: int = DEFAULT_LEVEL,
+        file_level: int = logging.INFO,
+        console_level: int = logging.INFO
+    ) -> QueueListener:
+    """
+        Routes all logging through a queue to a background writer, so that
+        logging never does file I/O on the render or GPIO threads. The log file
+        gets one json record per line.
+
+        Returns the listener, which should be stopped on exit to flush the queue.
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+
+    log_queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ModuleLevelFilter(MODULE_LEVELS if levels is None else levels, default_level))
+    queue_handler.addFilter(RateLimitFilter())
+
+    file_handler = RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setLevel(file_level)
+    file_handler.setFormatter(JsonFormatter())
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(levelname)s - %(module)s:%(funcName)s - %(message)s'
+    ))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(logging.DEBUG)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(
+        log_queue,
+        # the ring buffer goes first, so buffered context precedes the error in the file
+        RingBufferHandler(file_handler), file_handler, console_handler,
+        respect_handler_level=True
+    )
+    listener.start()
+
+    return listener
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    filename = os.path.join(tempfile.mkdtemp(), 'test.log')
+    listener = setup_logging(filename)
+
+    start = time.perf_counter()
+    for i in range(10000):
+        logging.debug(f'Debug line {i}')
+    logging.info('Repetitive message')
+    for _ in range(20):
+        logging.info('Repetitive message')
+    logging.error('Something went wrong')
+    elapsed = time.perf_counter() - start
+
+    listener.stop()
+    with open(filename) as log_file:
+        lines = log_file.readlines()
+    print(f'Logged 10022 records in {elapsed * 1000:.1f} ms; {len(lines)} lines written to {filename}')
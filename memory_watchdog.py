@@ -0,0 +1,283 @@
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from threading import Thread, Event
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+# cheap numbers (resident memory, thread count, subsystem sizes) are sampled
+# every SAMPLE_PERIOD. tracemalloc slows down allocation heavy code several
+# times over, so it only runs while resident memory grows faster than
+# RISING_GROWTH_PER_HOUR, to explain the growth in a report. A full snapshot
+# holds the GIL for a while on a big heap (stalling the render loop), so one is
+# only taken when tracing starts, for a report, and every SNAPSHOT_PERIOD
+SAMPLE_PERIOD: float = 60  # seconds
+SNAPSHOT_PERIOD: float = 15 * 60  # seconds
+TRACEMALLOC_FRAMES: int = 1
+
+# samples kept to compute growth trends over
+HISTORY_SIZE: int = 60
+
+# crossing any of these writes a report to DUMP_DIR, at most once per DUMP_INTERVAL;
+# the growth limit applies to resident memory, traced memory and every subsystem
+MAX_RESIDENT_BYTES: int = 768 * 1024 * 1024
+MAX_TRACED_BYTES: int = 256 * 1024 * 1024
+MAX_GROWTH_PER_HOUR: int = 16 * 1024 * 1024  # bytes
+RISING_GROWTH_PER_HOUR: int = MAX_GROWTH_PER_HOUR // 4  # bytes
+# the thread count is compared to the highest count seen in the first
+# SETTLE_TIME, when thread pools have started their workers
+SETTLE_TIME: float = 5 * 60  # seconds
+MAX_EXTRA_THREADS: int = 32
+MIN_TREND_SAMPLES: int = 10
+DUMP_DIR: str = './logs'
+DUMP_INTERVAL: float = 60 * 60  # seconds
+DUMP_TOP_LINES: int = 40
+
+
+def surface_bytes(surface) -> int:
+    """ The size of the pixel data of a pygame.Surface. """
+    return surface.get_pitch() * surface.get_height()
+
+
+def resident_bytes() -> int:
+    """
+        The resident memory of this process. This includes what tracemalloc
+        does not see, such as SDL surfaces and mixer buffers.
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # not Linux; the peak resident memory is the closest there is
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Sample:
+    __slots__ = ('time', 'resident', 'traced', 'threads', 'subsystems')
+
+    def __init__(self, time: float, resident: int, traced: Optional[int], threads: int, subsystems: Dict[str, int]) -> None:
+        self.time: float = time
+        self.resident: int = resident
+        self.traced: Optional[int] = traced  # None while not tracing
+        self.threads: int = threads
+        self.subsystems: Dict[str, int] = subsystems
+
+
+class MemoryWatchdog(Thread):
+    """
+        Tracks memory and thread usage of the running app. Subsystems register
+        a provider that returns their size in bytes. When a threshold is
+        crossed, a report is written to DUMP_DIR; if memory was traced, it
+        includes the growth per source line since the previous snapshot.
+    """
+    def __init__(self, sample_period: float = SAMPLE_PERIOD, snapshot_period: float = SNAPSHOT_PERIOD) -> None:
+        super().__init__(name='memory-watchdog', daemon=True)
+
+        self._sample_period: float = sample_period
+        self._snapshot_period: float = snapshot_period
+
+        self._providers: Dict[str, Callable[[], int]] = {}
+        self._stop_event: Event = Event()
+
+        self._history: Deque[_Sample] = deque(maxlen=HISTORY_SIZE)
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._snapshot_time: float = 0
+        self._last_dump: float = -DUMP_INTERVAL
+        # whether tracemalloc was started here (rather than with -X tracemalloc)
+        self._tracing: bool = False
+
+        self._start_time: float = time.monotonic()
+        self._settled_threads: Optional[int] = None
+
+    def register(self, name: str, provider: Callable[[], int]) -> None:
+        self._providers[name] = provider
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self._sample_period):
+            try:
+                self.sample()
+            except Exception:
+                logging.exception('Memory watchdog sample failed')
+
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def sample(self) -> None:
+        now: float = time.monotonic()
+        resident: int = resident_bytes()
+        traced: Optional[int] = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        threads: int = threading.active_count()
+        subsystems: Dict[str, int] = self._subsystem_sizes()
+        self._history.append(_Sample(now, resident, traced, threads, subsystems))
+
+        resident_trend: Optional[float] = self._trend(lambda sample: sample.resident)
+        traced_trend: Optional[float] = self._trend(lambda sample: sample.traced)
+        thread_trend: Optional[float] = self._trend(lambda sample: sample.threads)
+        subsystem_trends: Dict[str, Optional[float]] = {
+            name: self._trend(lambda sample: sample.subsystems.get(name)) for name in subsystems
+        }
+
+        logging.info(
+            f'Memory: {resident / 1048576:.1f} MB resident' +
+            (f', {traced / 1048576:.1f} MB traced' if traced is not None else '') +
+            f', {threads} threads; ' +
+            ', '.join(f'{name}: {size / 1048576:.1f} MB' for name, size in subsystems.items()) +
+            (f'; trend {resident_trend / 1048576:+.1f} MB/h, {thread_trend:+.1f} threads/h' if resident_trend is not None else '')
+        )
+
+        reasons: List[str] = []
+        if resident > MAX_RESIDENT_BYTES:
+            reasons.append(f'resident memory {resident} > {MAX_RESIDENT_BYTES} bytes')
+        if traced is not None and traced > MAX_TRACED_BYTES:
+            reasons.append(f'traced memory {traced} > {MAX_TRACED_BYTES} bytes')
+        for name, trend in [('resident memory', resident_trend), ('traced memory', traced_trend)] + list(subsystem_trends.items()):
+            if trend is not None and trend > MAX_GROWTH_PER_HOUR:
+                reasons.append(f'{name} growth {trend:.0f} > {MAX_GROWTH_PER_HOUR} bytes/h')
+        memory_reasons: int = len(reasons)
+
+        if self._settled_threads is None:
+            if now - self._start_time >= SETTLE_TIME:
+                self._settled_threads = max(sample.threads for sample in self._history)
+                logging.info(f'Memory watchdog: {self._settled_threads} threads after startup')
+        elif threads > self._settled_threads + MAX_EXTRA_THREADS:
+            reasons.append(f'{threads} > {self._settled_threads} + {MAX_EXTRA_THREADS} threads')
+
+        # trace allocations while memory grows, so a report can tell where it goes
+        rising: bool = memory_reasons > 0 or (resident_trend is not None and resident_trend > RISING_GROWTH_PER_HOUR)
+        if rising and not tracemalloc.is_tracing():
+            logging.info('Memory watchdog: memory is growing; tracing allocations')
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._tracing = True
+            self._take_snapshot()
+            # a report waits for the next sample, so it can show where the memory went
+            return
+        if not rising and self._tracing and resident_trend is not None and resident_trend < RISING_GROWTH_PER_HOUR / 2:
+            logging.info('Memory watchdog: memory is stable again; no longer tracing allocations')
+            tracemalloc.stop()
+            self._tracing = False
+            self._snapshot = None
+
+        if reasons and now - self._last_dump > DUMP_INTERVAL:
+            self._last_dump = now
+            # a thread report does not need the (costly) growth by line
+            self._dump(reasons, subsystems, with_memory=memory_reasons > 0)
+        elif (
+            rising and tracemalloc.is_tracing() and
+            (self._snapshot is None or now - self._snapshot_time > self._snapshot_period)
+        ):
+            # a starting point for the growth by line, should a report follow
+            self._take_snapshot()
+
+    def _subsystem_sizes(self) -> Dict[str, int]:
+        sizes: Dict[str, int] = {}
+        for name, provider in self._providers.items():
+            try:
+                sizes[name] = provider()
+            except Exception as e:
+                logging.debug(f'Memory provider {name} failed: {e!r}')
+        return sizes
+
+    def _trend(self, value: Callable[[_Sample], Optional[float]]) -> Optional[float]:
+        """ The least squares slope of a value over the history, per hour; samples without the value are skipped. """
+        points: List[Tuple[float, float]] = [
+            (sample.time, value(sample)) for sample in self._history if value(sample) is not None
+        ]
+        if len(points) < MIN_TREND_SAMPLES:
+            return None
+
+        mean_time: float = sum(t for t, _ in points) / len(points)
+        mean_value: float = sum(v for _, v in points) / len(points)
+        variance: float = sum((t - mean_time) ** 2 for t, _ in points)
+        if variance == 0:
+            return None
+        slope: float = sum((t - mean_time) * (v - mean_value) for t, v in points) / variance
+        return slope * 3600
+
+    def _take_snapshot(self) -> tracemalloc.Snapshot:
+        # filtering is left to the report, it takes longer than the snapshot itself
+        snapshot: tracemalloc.Snapshot = tracemalloc.take_snapshot()
+        self._snapshot = snapshot
+        self._snapshot_time = time.monotonic()
+        return snapshot
+
+    def _dump(self, reasons: List[str], subsystems: Dict[str, int], with_memory: bool = True) -> None:
+        previous: Optional[tracemalloc.Snapshot] = self._snapshot
+        previous_time: float = self._snapshot_time
+        snapshot: Optional[tracemalloc.Snapshot] = None
+        if with_memory and tracemalloc.is_tracing():
+            snapshot = self._take_snapshot()
+
+        filename: str = os.path.join(DUMP_DIR, time.strftime('memory-%Y%m%d-%H%M%S.txt'))
+        logging.warning(f'Memory watchdog: {"; ".join(reasons)}; writing report to {filename}')
+
+        thread_names: Counter = Counter(
+            thread.name.rstrip('0123456789') for thread in threading.enumerate()
+        )
+        try:
+            os.makedirs(DUMP_DIR, exist_ok=True)
+            with open(filename, 'w') as dump_file:
+                dump_file.write('Reasons:\n')
+                dump_file.writelines(f'  {reason}\n' for reason in reasons)
+
+                dump_file.write('\nSubsystems:\n')
+                dump_file.writelines(f'  {name}: {size} bytes\n' for name, size in subsystems.items())
+
+                dump_file.write(f'\nThreads ({threading.active_count()}):\n')
+                dump_file.writelines(f'  {count} x {name}\n' for name, count in thread_names.most_common())
+
+                dump_file.write('\nHistory (seconds, resident bytes, traced bytes, threads):\n')
+                dump_file.writelines(
+                    f'  {sample.time - self._history[0].time:.0f}, {sample.resident}, {sample.traced}, {sample.threads}\n'
+                    for sample in self._history
+                )
+
+                if snapshot is None:
+                    if with_memory:
+                        dump_file.write('\nAllocations were not traced yet; the next report will include them.\n')
+                    return
+
+                filters: List[tracemalloc.Filter] = [
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+                ]
+                if previous is not None:
+                    dump_file.write(f'\nGrowth over the last {time.monotonic() - previous_time:.0f}s by line:\n')
+                    stats = snapshot.filter_traces(filters).compare_to(previous.filter_traces(filters), 'lineno')
+                else:
+                    dump_file.write('\nLargest allocations by line:\n')
+                    stats = snapshot.filter_traces(filters).statistics('lineno')
+                for stat in stats[:DUMP_TOP_LINES]:
+                    dump_file.write(f'  {stat}\n')
+        except OSError as e:
+            logging.error(f'Failed to write memory report: {e}')
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    DUMP_DIR = tempfile.mkdtemp()
+    MIN_TREND_SAMPLES = 3
+
+    leak: List[bytearray] = []
+    watchdog = MemoryWatchdog(sample_period=0.2)
+    watchdog.register('leak', lambda: sum(len(chunk) for chunk in leak))
+    watchdog.start()
+
+    for _ in range(10):
+        leak.append(bytearray(1024 * 1024))
+        time.sleep(0.2)
+
+    watchdog.stop()
+    watchdog.join()
+    for name in os.listdir(DUMP_DIR):
+        with open(os.path.join(DUMP_DIR, name)) as dump_file:
+            print(dump_file.read())
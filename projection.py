@@ -0,0 +1,108 @@
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from hackerspaces import HackerSpace
+
+# ((lon, lat), (x, y)) pairs; derived from the empirical center/scale previously
+# used to match the geo coordinates to data/hsnl.png
+HSNL_MAP_FILE: str = 'data/hsnl.png'
+HSNL_CONTROL_POINTS: List[Tuple[Tuple[float, float], Tuple[float, float]]] = [
+    ((3.3, 53.6), (-5.83, -5.04)),
+    ((7.3, 50.7), (1115.02, 1273.84)),
+]
+
+
+class MapProjection:
+    """
+        Maps geo coordinates to pixels on a background map, as a scale and
+        offset per axis. With `mercator` set, latitudes are projected with the
+        Mercator projection first, which suits maps covering larger areas.
+    """
+    def __init__(self, x_scale: float, x_offset: float, y_scale: float, y_offset: float, mercator: bool = False) -> None:
+        self.x_scale: float = x_scale
+        self.x_offset: float = x_offset
+        self.y_scale: float = y_scale
+        self.y_offset: float = y_offset
+        self.mercator: bool = mercator
+
+        # (name, lat, lon) -> pixel coordinates
+        self._cache: Dict[Tuple[str, float, float], Tuple[int, int]] = {}
+
+    @classmethod
+    def from_control_points(
+            cls,
+            points: Sequence[Tuple[Tuple[float, float], Tuple[float, float]]],
+            mercator: bool = False
+        ) -> 'MapProjection':
+        """
+            Calibrates a projection from two or more ((lon, lat), (x, y)) pairs
+            with a least squares fit per axis.
+        """
+        if len(points) < 2:
+            raise ValueError('At least two control points are needed')
+
+        x_scale, x_offset = _fit([lon for (lon, _), _ in points], [x for _, (x, _) in points])
+        y_scale, y_offset = _fit(
+            [_mercator(lat) if mercator else lat for (_, lat), _ in points],
+            [y for _, (_, y) in points]
+        )
+        return cls(x_scale, x_offset, y_scale, y_offset, mercator)
+
+    def project(self, lon: float, lat: float) -> Tuple[int, int]:
+        y: float = _mercator(lat) if self.mercator else lat
+        return (
+            int(round(lon * self.x_scale + self.x_offset)),
+            int(round(y * self.y_scale + self.y_offset))
+        )
+
+    def project_spaces(self, spaces: List[HackerSpace]) -> List[Tuple[int, int]]:
+        """
+            Projects a list of spaces, using cached coordinates for spaces that
+            were projected before with the same position. The cache only keeps
+            the spaces of the latest dataset.
+        """
+        cache: Dict[Tuple[str, float, float], Tuple[int, int]] = self._cache
+        if len(cache) == len(spaces):
+            try:
+                return [cache[(space.name, space.lat, space.lon)] for space in spaces]
+            except KeyError:
+                pass
+
+        new_cache: Dict[Tuple[str, float, float], Tuple[int, int]] = {}
+        for space in spaces:
+            key = (space.name, space.lat, space.lon)
+            position: Optional[Tuple[int, int]] = cache.get(key)
+            new_cache[key] = position if position is not None else self.project(space.lon, space.lat)
+        self._cache = new_cache
+
+        return [new_cache[(space.name, space.lat, space.lon)] for space in spaces]
+
+    def cropped(self, rect: Tuple[int, int, int, int], size: Tuple[int, int]) -> 'MapProjection':
+        """ The projection for the part `rect` of the map, scaled to `size`. """
+        x, y, width, height = rect
+        x_zoom: float = size[0] / width
+        y_zoom: float = size[1] / height
+        return MapProjection(
+            self.x_scale * x_zoom, (self.x_offset - x) * x_zoom,
+            self.y_scale * y_zoom, (self.y_offset - y) * y_zoom,
+            self.mercator
+        )
+
+
+def _fit(values: List[float], targets: List[float]) -> Tuple[float, float]:
+    count: int = len(values)
+    mean_value: float = sum(values) / count
+    mean_target: float = sum(targets) / count
+    variance: float = sum((value - mean_value) ** 2 for value in values)
+    if variance == 0:
+        raise ValueError('Control points need to differ in both longitude and latitude')
+
+    scale: float = sum((value - mean_value) * (target - mean_target) for value, target in zip(values, targets)) / variance
+    return scale, mean_target - scale * mean_value
+
+
+def _mercator(lat: float) -> float:
+    return math.degrees(math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)))
+
+
+HSNL_PROJECTION: MapProjection = MapProjection.from_control_points(HSNL_CONTROL_POINTS)
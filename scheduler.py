@@ -0,0 +1,152 @@
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from threading import Event, Lock
+from typing import Mapping, Optional
+
+# upper bound for server supplied delays, so a bogus header cannot stall refreshes
+MAX_SERVER_DELAY: float = 3600  # seconds
+
+
+class AdaptivePollScheduler:
+    """
+        Decides when to poll a resource next. The interval halves (down to
+        `min_interval`) when a poll finds changed data and grows by half (up to
+        `max_interval`) when it does not. Cache-Control max-age and Retry-After
+        response headers postpone the next poll, and every delay gets some
+        jitter so several kiosks do not end up polling in lockstep.
+
+        The polling thread calls `wait` in a loop; it sleeps on an event until
+        the next deadline, `wake` or `stop`.
+    """
+    def __init__(
+            self,
+            base_interval: float,
+            min_interval: Optional[float] = None,
+            max_interval: Optional[float] = None,
+            jitter: float = 0.1
+        ) -> None:
+        self.base_interval: float = base_interval
+        self.min_interval: float = min_interval if min_interval is not None else base_interval / 2
+        self.max_interval: float = max_interval if max_interval is not None else base_interval * 10
+        self.jitter: float = jitter
+
+        self.interval: float = base_interval
+        self.requests: int = 0
+
+        self._start_time: float = time.monotonic()
+        self._deadline: float = self._start_time  # poll right away
+        # a wake that arrived while a poll was running, for record() to keep
+        self._wake_deadline: Optional[float] = None
+        self._lock: Lock = Lock()
+        self._wake_event: Event = Event()
+        self._stop_event: Event = Event()
+
+    def wait(self) -> bool:
+        """
+            Blocks until the next poll is due. Returns False when the scheduler
+            was stopped.
+        """
+        while not self._stop_event.is_set():
+            with self._lock:
+                now: float = time.monotonic()
+                timeout: float = self._deadline - now
+                if timeout <= 0:
+                    # this poll serves the wakes that are due
+                    if self._wake_deadline is not None and self._wake_deadline <= now:
+                        self._wake_deadline = None
+                    return True
+            if self._wake_event.wait(timeout):
+                self._wake_event.clear()
+        return False
+
+    def wake(self, delay: float = 0) -> None:
+        """ Moves the next poll forward to `delay` seconds from now. """
+        with self._lock:
+            deadline: float = time.monotonic() + delay
+            self._deadline = min(self._deadline, deadline)
+            self._wake_deadline = deadline if self._wake_deadline is None else min(self._wake_deadline, deadline)
+        self._wake_event.set()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def record(self, changed: bool, headers: Optional[Mapping[str, str]] = None) -> float:
+        """
+            Records the outcome of a poll and schedules the next one.
+
+            Args:
+                changed (bool): Whether the poll returned changed data
+                headers (Mapping): The response headers, if there was a response
+
+            Returns:
+                float: The delay until the next poll, in seconds
+        """
+        self.requests += 1
+
+        if changed:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+
+        delay: float = self.interval
+        if headers is not None:
+            delay = max(delay, _server_delay(headers))
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        with self._lock:
+            self._deadline = time.monotonic() + delay
+            if self._wake_deadline is not None:
+                # woken while polling; that poll may have missed the change
+                self._deadline = min(self._deadline, self._wake_deadline)
+                self._wake_deadline = None
+                delay = max(0, self._deadline - time.monotonic())
+        logging.debug(
+            f'Next poll in {delay:.1f}s; {self.requests} requests, '
+            f'{self.requests_saved()} saved compared to polling every {self.base_interval}s'
+        )
+        return delay
+
+    def requests_saved(self) -> int:
+        """ The number of requests saved compared to polling every `base_interval`. """
+        fixed_requests: int = int((time.monotonic() - self._start_time) / self.base_interval) + 1
+        return fixed_requests - self.requests
+
+
+def _server_delay(headers: Mapping[str, str]) -> float:
+    delay: float = 0
+
+    retry_after: Optional[str] = headers.get('Retry-After')
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+
+    cache_control: str = headers.get('Cache-Control', '')
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age':
+            try:
+                delay = max(delay, float(value))
+            except ValueError:
+                pass
+
+    return min(max(delay, 0), MAX_SERVER_DELAY)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    scheduler = AdaptivePollScheduler(1, 0.5, 4)
+    for poll in range(8):
+        scheduler.wait()
+        logging.info(f'Poll {poll}')
+        scheduler.record(poll < 2, {'Cache-Control': 'max-age=0'})
+        if poll == 5:
+            scheduler.wake()
@@ -0,0 +1,384 @@
+from threading import Thread, Event, Lock, BoundedSemaphore, local
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from urllib.parse import urlsplit
+import logging
+import math
+import re
+import time
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+from hackerspaces import HackerSpace
+from scheduler import AdaptivePollScheduler
+from spacestate import SpaceState
+
+DIRECTORY_URL: str = 'https://directory.spaceapi.io/'
+REFRESH_PERIOD: int = 300  # seconds
+MIN_REFRESH_PERIOD: int = 120  # seconds
+MAX_REFRESH_PERIOD: int = 1800  # seconds
+
+MAX_CONCURRENCY: int = 64  # requests in flight
+MAX_PER_HOST: int = 4  # requests in flight to a single host
+ENDPOINT_TIMEOUT: float = 5  # seconds
+# how long stop() waits for a running refresh; requests in flight are not aborted
+STOP_TIMEOUT: float = 1  # seconds
+
+# endpoints that failed QUARANTINE_AFTER times in a row are skipped for a while,
+# doubling from QUARANTINE_PERIOD up to MAX_QUARANTINE_PERIOD
+QUARANTINE_AFTER: int = 2
+QUARANTINE_PERIOD: float = 600  # seconds
+MAX_QUARANTINE_PERIOD: float = 6 * 3600  # seconds
+
+# spaces closer together than this are considered the same space when merging
+DUPLICATE_DISTANCE: float = 50  # meters
+
+
+class _Endpoint:
+    __slots__ = ('url', 'etag', 'last_modified', 'space', 'failures', 'quarantined_until')
+
+    def __init__(self, url: str) -> None:
+        self.url: str = url
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.space: Optional[HackerSpace] = None
+        self.failures: int = 0
+        self.quarantined_until: float = 0
+
+
+def parse_space(data: Dict[str, Any]) -> HackerSpace:
+    """
+        Reads the name, location and state from a SpaceAPI endpoint response.
+        Raises KeyError, TypeError or ValueError for responses without them.
+    """
+    location = data['location']
+    state_data = data.get('state')
+    is_open = state_data.get('open') if isinstance(state_data, dict) else None
+
+    state: SpaceState = SpaceState.UNDETERMINED
+    if is_open is True:
+        state = SpaceState.OPEN
+    elif is_open is False:
+        state = SpaceState.CLOSED
+
+    return HackerSpace(str(data['space']), float(location['lat']), float(location['lon']), state)
+
+
+class SpaceApiFederation:
+    """
+        Polls the SpaceAPI directory and all endpoints listed in it. Endpoints
+        are fetched concurrently, with a cap on the total and per-host number
+        of requests in flight. Responses are cached per endpoint and refreshed
+        with conditional requests; endpoints that keep failing are quarantined.
+    """
+    def __init__(
+            self,
+            on_spaces_changed: Optional[Callable[[List[HackerSpace]], None]] = None,
+            directory_url: str = DIRECTORY_URL,
+            max_concurrency: int = MAX_CONCURRENCY,
+            max_per_host: int = MAX_PER_HOST,
+            start: bool = True
+        ) -> None:
+        self._on_spaces_changed: Optional[Callable[[List[HackerSpace]], None]] = on_spaces_changed
+        self.spaces: List[HackerSpace] = []
+
+        self._directory_url: str = directory_url
+        self._directory: _Endpoint = _Endpoint(directory_url)
+        self._endpoints: Dict[str, _Endpoint] = {}
+
+        self._max_per_host: int = max_per_host
+        self._host_slots: Dict[str, BoundedSemaphore] = {}
+        self._host_slots_lock: Lock = Lock()
+        self._sessions: local = local()
+        # kept for the lifetime of the federation, so workers keep their connections
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(max_concurrency, thread_name_prefix='spaceapi')
+
+        self.scheduler: AdaptivePollScheduler = AdaptivePollScheduler(
+            REFRESH_PERIOD, MIN_REFRESH_PERIOD, MAX_REFRESH_PERIOD
+        )
+        self._stop_event: Event = Event()
+        self._thread: Optional[Thread] = None
+        if start:
+            self._thread = Thread(target=self._run, name='spaceapi', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        logging.debug('Stopping SpaceAPI updates')
+        self._stop_event.set()
+        self.scheduler.stop()
+        if self._thread is not None:
+            # a daemon thread; do not hold up quitting for fetches in flight
+            self._thread.join(STOP_TIMEOUT)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def refresh(self) -> List[HackerSpace]:
+        """ Fetches the directory and all endpoints, and returns the resulting spaces. """
+        start_time: float = time.perf_counter()
+
+        failures: int = self._directory.failures
+        directory: Optional[Dict[str, Any]] = self._fetch(self._directory)
+        if isinstance(directory, dict):
+            self._directory.failures = 0
+            urls = {url for url in directory.values() if isinstance(url, str)}
+            self._endpoints = {url: self._endpoints.get(url) or _Endpoint(url) for url in urls}
+        elif directory is not None:
+            self._invalidate(self._directory, 'not an object')
+        if self._directory.failures > failures:
+            logging.warning(
+                f'Failed to refresh the SpaceAPI directory {self._directory_url} '
+                f'({self._directory.failures} failures in a row); using the last known endpoints'
+            )
+
+        now: float = time.monotonic()
+        endpoints: List[_Endpoint] = [
+            endpoint for endpoint in self._endpoints.values() if endpoint.quarantined_until <= now
+        ]
+        for endpoint, data in zip(endpoints, self._pool.map(self._fetch, endpoints)):
+            if data is None:
+                continue
+            try:
+                endpoint.space = parse_space(data)
+                endpoint.failures = 0
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                endpoint.space = None
+                self._invalidate(endpoint, repr(e))
+
+        spaces: List[HackerSpace] = [
+            endpoint.space for endpoint in self._endpoints.values() if endpoint.space is not None
+        ]
+        quarantined: int = len(self._endpoints) - len(endpoints)
+        logging.info(
+            f'Refreshed {len(endpoints)} SpaceAPI endpoints ({quarantined} quarantined) into '
+            f'{len(spaces)} spaces in {time.perf_counter() - start_time:.2f}s'
+        )
+
+        return spaces
+
+    def _run(self) -> None:
+        while self.scheduler.wait():
+            try:
+                spaces: List[HackerSpace] = self.refresh()
+            except (CancelledError, RuntimeError):
+                # stop() shut the pool down during the refresh
+                if self._stop_event.is_set():
+                    return
+                raise
+            if self._stop_event.is_set():
+                return
+            changed: bool = _space_tuples(spaces) != _space_tuples(self.spaces)
+            self.scheduler.record(changed)
+            if not changed:
+                continue
+
+            self.spaces = spaces
+            if self._on_spaces_changed is not None:
+                self._on_spaces_changed(self.spaces)
+
+    def _fetch(self, endpoint: _Endpoint) -> Optional[Dict[str, Any]]:
+        """
+            Fetches an endpoint with a conditional request. Returns None when the
+            endpoint is unchanged or failed; on failure the endpoint keeps its
+            last known data, and it is quarantined after repeated failures.
+            The caller validates returned data, and resets `failures` if it is
+            valid or calls `_invalidate` if not.
+        """
+        if self._stop_event.is_set():
+            return None
+
+        headers: Dict[str, str] = {}
+        if endpoint.etag:
+            headers['If-None-Match'] = endpoint.etag
+        if endpoint.last_modified:
+            headers['If-Modified-Since'] = endpoint.last_modified
+
+        try:
+            with self._host_slot(endpoint.url):
+                # waiting for a slot can take a while; stop() may have come in meanwhile
+                if self._stop_event.is_set():
+                    return None
+                response = self._session().get(endpoint.url, headers=headers, timeout=ENDPOINT_TIMEOUT)
+                if response.status_code == 304:
+                    data = None
+                else:
+                    response.raise_for_status()
+                    data = response.json()
+        except Exception as e:
+            self._record_failure(endpoint, str(e))
+            return None
+
+        if data is None:
+            # unchanged, so still the valid data we had
+            endpoint.failures = 0
+        endpoint.etag = response.headers.get('ETag', endpoint.etag if data is None else None)
+        endpoint.last_modified = response.headers.get('Last-Modified', endpoint.last_modified if data is None else None)
+        return data
+
+    def _invalidate(self, endpoint: _Endpoint, reason: str) -> None:
+        """ Handles invalid data from an endpoint like a failed fetch. """
+        # fetch it in full next time, rather than getting a 304 for the invalid data
+        endpoint.etag = None
+        endpoint.last_modified = None
+        self._record_failure(endpoint, f'invalid data: {reason}')
+
+    def _record_failure(self, endpoint: _Endpoint, reason: str) -> None:
+        """ Counts a failed fetch or invalid response, and quarantines the endpoint after repeated ones. """
+        endpoint.failures += 1
+        if endpoint.failures >= QUARANTINE_AFTER:
+            period: float = min(
+                QUARANTINE_PERIOD * 2 ** (endpoint.failures - QUARANTINE_AFTER), MAX_QUARANTINE_PERIOD
+            )
+            endpoint.quarantined_until = time.monotonic() + period
+            logging.debug(f'Quarantining {endpoint.url} for {period:.0f}s: {reason}')
+
+    def _host_slot(self, url: str) -> BoundedSemaphore:
+        host: str = urlsplit(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = BoundedSemaphore(self._max_per_host)
+            return self._host_slots[host]
+
+    def _session(self):
+        session = getattr(self._sessions, 'session', None)
+        if session is None:
+            import requests  # imported here to keep it off the startup path
+
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=self._max_per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._sessions.session = session
+        return session
+
+
+def merge_spaces(sources: List[List[HackerSpace]]) -> List[HackerSpace]:
+    """
+        Merges lists of spaces into one list without duplicates. The sources are
+        in order of priority: a space from a later source is dropped when an
+        earlier source has a space with the same name, or one within
+        DUPLICATE_DISTANCE meters.
+    """
+    merged: List[HackerSpace] = []
+    names: set = set()
+    # spaces by (lat, lon) grid cell; cells are larger than DUPLICATE_DISTANCE
+    cells: Dict[Tuple[int, int], List[HackerSpace]] = {}
+    cell_size: float = DUPLICATE_DISTANCE / 111000 * 2  # degrees latitude
+
+    for source in sources:
+        added: List[Tuple[str, Tuple[int, int], HackerSpace]] = []
+        for space in source:
+            name: str = _normalize_name(space.name)
+            cell: Tuple[int, int] = (int(space.lat // cell_size), int(space.lon // cell_size))
+            if name in names or _has_neighbour(cells, cell, space):
+                continue
+            merged.append(space)
+            added.append((name, cell, space))
+
+        # spaces are only compared with those of higher priority sources
+        for name, cell, space in added:
+            names.add(name)
+            cells.setdefault(cell, []).append(space)
+
+    return merged
+
+
+def _normalize_name(name: str) -> str:
+    return re.sub(r'[^0-9a-z]', '', name.casefold())
+
+
+def _has_neighbour(cells: Dict[Tuple[int, int], List[HackerSpace]], cell: Tuple[int, int], space: HackerSpace) -> bool:
+    # longitude cells shrink towards the poles; widen the search accordingly
+    lon_range: int = 1 + int(1 / max(math.cos(math.radians(space.lat)), 0.01))
+    for lat_cell in range(cell[0] - 1, cell[0] + 2):
+        for lon_cell in range(cell[1] - lon_range, cell[1] + lon_range + 1):
+            for other in cells.get((lat_cell, lon_cell), ()):
+                if _distance(space, other) < DUPLICATE_DISTANCE:
+                    return True
+    return False
+
+
+def _distance(a: HackerSpace, b: HackerSpace) -> float:
+    # equirectangular approximation; fine at these distances
+    x: float = math.radians(b.lon - a.lon) * math.cos(math.radians((a.lat + b.lat) / 2))
+    y: float = math.radians(b.lat - a.lat)
+    return math.hypot(x, y) * 6371000
+
+
+def _space_tuples(spaces: List[HackerSpace]) -> List[Tuple[str, float, float, SpaceState]]:
+    return [(space.name, space.lat, space.lon, space.state) for space in spaces]
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from multiprocessing import Process
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if len(sys.argv) < 2 or sys.argv[1] != '--local':
+        federation = SpaceApiFederation(start=False)
+        for space in federation.refresh():
+            logging.info(f'{space.name} - Lat: {space.lat}, Lon: {space.lon}, State: {space.state}')
+        sys.exit()
+
+    # stand-in servers: a directory listing `count` endpoints spread over a few
+    # hosts, where every 100th endpoint is broken
+    count: int = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    hosts: int = 8
+    base_port: int = 18400
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self) -> None:
+            if self.path == '/directory.json':
+                body = json.dumps({
+                    f'Space {i}': f'http://127.0.0.1:{base_port + 1 + i % hosts}/space/{i}' for i in range(count)
+                }).encode()
+            else:
+                i = int(self.path.rsplit('/', 1)[1])
+                if i % 100 == 99:
+                    self.send_error(500)
+                    return
+                if self.headers.get('If-None-Match') == f'"{i}"':
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = json.dumps({
+                    'api_compatibility': ['14'],
+                    'space': f'Space {i}',
+                    'location': {'lat': 50 + (i % 100) / 20, 'lon': 3 + (i // 100) / 5},
+                    'state': {'open': i % 3 == 0},
+                }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if self.path != '/directory.json':
+                self.send_header('ETag', f'"{i}"')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    def serve(port: int) -> None:
+        ThreadingHTTPServer(('127.0.0.1', port), StandInHandler).serve_forever()
+
+    servers = [Process(target=serve, args=(base_port + i,), daemon=True) for i in range(hosts + 1)]
+    for server in servers:
+        server.start()
+    time.sleep(0.5)
+
+    federation = SpaceApiFederation(
+        directory_url=f'http://127.0.0.1:{base_port}/directory.json', start=False
+    )
+    for attempt in ['first', 'second', 'third']:
+        start_time: float = time.perf_counter()
+        spaces = federation.refresh()
+        logging.info(f'{attempt} refresh: {len(spaces)} spaces in {time.perf_counter() - start_time:.2f}s')
+
+    merged = merge_spaces([spaces[:10], spaces])
+    logging.info(f'Merged {len(spaces) + 10} spaces into {len(merged)}')
+
+    federation.stop()
+    for server in servers:
+        server.terminate()
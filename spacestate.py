@@ -1,8 +1,7 @@
-import requests
 from threading import Thread
 from enum import Enum
 import logging
-from typing import Optional
+from typing import Callable, Optional
 
 from debounce import debounce
 from spacestatesecrets import API_KEY
@@ -17,11 +16,15 @@ class SpaceState(Enum):
 
 
 class _PostStateThread(Thread):
-    def __init__(self, state: SpaceState) -> None:
+    def __init__(self, state: SpaceState, on_posted: Optional[Callable[[SpaceState], None]] = None) -> None:
         super().__init__()
+        self._state: SpaceState = state
         self._space_open: str = 'true' if state == SpaceState.OPEN else 'false'
+        self._on_posted: Optional[Callable[[SpaceState], None]] = on_posted
 
     def run(self) -> None:
+        import requests  # imported here to keep it off the startup path
+
         logging.debug(f'POST state \'{self._space_open}\' to {SPACESTATE_URL}')
         try:
             response = requests.post(SPACESTATE_URL, json={
@@ -42,10 +45,14 @@ class _PostStateThread(Thread):
 
         logging.debug('State post success')
 
+        if self._on_posted is not None:
+            self._on_posted(self._state)
+
 
 class HackerHotelStateApi():
-    def __init__(self):
+    def __init__(self, on_state_posted: Optional[Callable[[SpaceState], None]] = None):
         self.state: Optional[SpaceState] = None
+        self._on_state_posted: Optional[Callable[[SpaceState], None]] = on_state_posted
 
     @debounce(1)
     def set_state(self, state: SpaceState) -> None:
@@ -55,7 +62,7 @@ class HackerHotelStateApi():
         logging.info(f'Setting HackerHotel state to {state.name}')
         self.state = state
 
-        post_thread = _PostStateThread(state)
+        post_thread = _PostStateThread(state, self._on_state_posted)
         post_thread.start()
 
 
@@ -0,0 +1,143 @@
+import logging
+import time
+import queue
+from threading import Thread, Event
+from typing import Any, Callable, Dict, List, Optional
+
+
+class StartupStep:
+    def __init__(
+            self, name: str,
+            run: Callable[[], Any],
+            on_ready: Optional[Callable[[Any], None]] = None,
+            depends_on: Optional[List[str]] = None
+        ) -> None:
+        self.name: str = name
+        self.run: Callable[[], Any] = run
+        self.on_ready: Optional[Callable[[Any], None]] = on_ready
+        self.depends_on: List[str] = depends_on if depends_on else []
+
+        self.done: Event = Event()
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+
+        # seconds since the start of the sequence
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+
+class StartupSequence:
+    """
+        Runs startup steps concurrently, each on its own thread as soon as the
+        steps it depends on are done. The `on_ready` callbacks of finished steps
+        are called from `poll`, so the main loop can wire up subsystems as they
+        become available while it keeps drawing frames.
+    """
+    def __init__(self) -> None:
+        self._steps: Dict[str, StartupStep] = {}
+        self._ready: queue.Queue = queue.Queue()
+        self._pending: int = 0
+        self._start_time: float = time.monotonic()
+        self._reported: bool = False
+
+    def add(
+            self, name: str,
+            run: Callable[[], Any],
+            on_ready: Optional[Callable[[Any], None]] = None,
+            depends_on: Optional[List[str]] = None
+        ) -> None:
+        self._steps[name] = StartupStep(name, run, on_ready, depends_on)
+
+    def measure(self, name: str, run: Callable[[], Any]) -> Any:
+        """ Runs a step synchronously, recording its timing with the others. """
+        step = StartupStep(name, run)
+        self._steps[name] = step
+        self._run_step(step)
+        step.done.set()
+        if step.error is not None:
+            raise step.error
+        return step.result
+
+    def start(self) -> None:
+        for step in self._steps.values():
+            if step.done.is_set():
+                continue
+            self._pending += 1
+            Thread(target=self._run_threaded, args=(step,), name=f'startup-{step.name}', daemon=True).start()
+
+    def poll(self) -> None:
+        while True:
+            try:
+                step: StartupStep = self._ready.get_nowait()
+            except queue.Empty:
+                break
+
+            self._pending -= 1
+            if step.error is None and step.on_ready is not None:
+                step.on_ready(step.result)
+
+        if self._pending == 0 and not self._reported:
+            self._reported = True
+            self.report()
+
+    def is_done(self) -> bool:
+        return self._pending == 0
+
+    def timings(self) -> Dict[str, Dict[str, float]]:
+        return {
+            step.name: {
+                'start': step.started,
+                'end': step.finished,
+                'duration': step.finished - step.started
+            } for step in self._steps.values() if step.finished is not None
+        }
+
+    def report(self) -> None:
+        total: float = max((step.finished or 0) for step in self._steps.values()) if self._steps else 0
+        logging.info(f'Startup finished in {total:.3f}s')
+        for step in sorted(self._steps.values(), key=lambda step: step.started or 0):
+            if step.finished is None:
+                continue
+            status: str = 'failed' if step.error is not None else 'ok'
+            logging.info(
+                f'  {step.name}: {step.finished - step.started:.3f}s '
+                f'({step.started:.3f}s - {step.finished:.3f}s, {status})'
+            )
+
+    def _run_threaded(self, step: StartupStep) -> None:
+        for dependency in step.depends_on:
+            self._steps[dependency].done.wait()
+            if self._steps[dependency].error is not None:
+                step.error = RuntimeError(f'Dependency {dependency} failed')
+                logging.error(f'Startup step {step.name} skipped: {dependency} failed')
+                break
+        else:
+            self._run_step(step)
+
+        step.done.set()
+        self._ready.put(step)
+
+    def _run_step(self, step: StartupStep) -> None:
+        step.started = time.monotonic() - self._start_time
+        try:
+            step.result = step.run()
+        except Exception as e:
+            logging.exception(f'Startup step {step.name} failed')
+            step.error = e
+        step.finished = time.monotonic() - self._start_time
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    sequence = StartupSequence()
+    sequence.measure('display', lambda: time.sleep(0.1))
+    sequence.add('slow', lambda: time.sleep(1), lambda _: logging.info('slow is ready'))
+    sequence.add('fast', lambda: time.sleep(0.2), lambda _: logging.info('fast is ready'))
+    sequence.add('after_fast', lambda: time.sleep(0.2), lambda _: logging.info('after_fast is ready'), ['fast'])
+    sequence.start()
+
+    while not sequence.is_done():
+        sequence.poll()
+        time.sleep(1 / 60)
+    sequence.poll()
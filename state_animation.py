@@ -2,11 +2,30 @@ import pygame
 import time
 import logging
 import json
+import math
 from enum import Enum
-from typing import List, Dict, Tuple, Optional
+from threading import Lock
+from typing import Any, List, Dict, Tuple, Optional
 
 from spacestate import SpaceState
 from gpio import FirmataGPIO, LampColor
+from memory_watchdog import surface_bytes
+
+
+EASING_TABLE_SIZE: int = 256
+
+# scaled actors are rendered when the timelines load, in steps of at least
+# SCALE_STEP and at most MAX_SCALE_VARIANTS or MAX_SEGMENT_BYTES per segment
+# (so large sprites get fewer steps), and cached up to MAX_TRANSFORMED_BYTES;
+# fading is done while blitting, so it needs no copies
+SCALE_STEP: float = 0.01
+MAX_SCALE_VARIANTS: int = 16
+MAX_TRANSFORMED_BYTES: int = 128 * 1024 * 1024
+MAX_SEGMENT_BYTES: int = MAX_TRANSFORMED_BYTES // 4
+
+# lamp changes are handed to the gpio output worker this far ahead of the frame
+# they belong to, so the relays switch on that frame rather than a few later
+LAMP_LOOKAHEAD: float = 0.1  # seconds
 
 
 class Easing(Enum):
@@ -15,19 +34,78 @@ class Easing(Enum):
     OUT = 2
 
 
+def easing_table(easing: Any = None) -> List[float]:
+    """
+        Samples an easing curve into a lookup table of EASING_TABLE_SIZE values.
+
+        Args:
+            easing: One of the Easing names, a cubic-bezier as a list of four
+                control values [x1, y1, x2, y2] (as in css), or an explicit
+                table as {"table": [...]} which is linearly resampled
+    """
+    steps: List[float] = [i / (EASING_TABLE_SIZE - 1) for i in range(EASING_TABLE_SIZE)]
+
+    if easing is None or easing == Easing.NONE.name:
+        return steps
+    if easing == Easing.IN.name:
+        return [t * t for t in steps]
+    if easing == Easing.OUT.name:
+        return [1 - (1 - t) * (1 - t) for t in steps]
+
+    if isinstance(easing, dict) and 'table' in easing:
+        table: List[float] = [float(value) for value in easing['table']]
+        if len(table) < 2:
+            raise ValueError('An easing table needs at least two values')
+        result: List[float] = []
+        for t in steps:
+            position: float = t * (len(table) - 1)
+            index: int = min(int(position), len(table) - 2)
+            fraction: float = position - index
+            result.append(table[index] + (table[index + 1] - table[index]) * fraction)
+        return result
+
+    if isinstance(easing, list) and len(easing) == 4:
+        x1, y1, x2, y2 = (float(value) for value in easing)
+        return [_cubic_bezier(t, x1, y1, x2, y2) for t in steps]
+
+    raise ValueError(f'Unknown easing: {easing}')
+
+
+def _cubic_bezier(x: float, x1: float, y1: float, x2: float, y2: float) -> float:
+    def bezier(t: float, p1: float, p2: float) -> float:
+        return 3 * (1 - t) * (1 - t) * t * p1 + 3 * (1 - t) * t * t * p2 + t * t * t
+
+    # x(t) is monotonic for x1, x2 in [0, 1]; find t for x by bisection
+    low: float = 0
+    high: float = 1
+    for _ in range(30):
+        middle: float = (low + high) / 2
+        if bezier(middle, x1, x2) < x:
+            low = middle
+        else:
+            high = middle
+    return bezier((low + high) / 2, y1, y2)
+
+
 class Assets():
     def __new__(cls):
         if not hasattr(cls, 'instance'):
             cls.instance = super(Assets, cls).__new__(cls)
+            cls.instance._surfaces: Dict[str, pygame.Surface] = {}
+            cls.instance._sounds: Dict[str, pygame.mixer.Sound] = {}
+            # in order of use, least recently used first
+            cls.instance._transformed: Dict[Tuple[str, float], pygame.Surface] = {}
+            cls.instance._transformed_bytes: int = 0
+            cls.instance.evictions: int = 0
         return cls.instance
 
-    def __init__(self):
-        self._surfaces:Dict[str, pygame.Surface] = {}
-        self._sounds:Dict[str, pygame.mixer.Sound] = {}
-
     def get_surface(self, filename: str) -> pygame.Surface:
         if filename not in self._surfaces:
-            self._surfaces[filename] = pygame.image.load(f'data/{filename}.png')
+            surface: pygame.Surface = pygame.image.load(f'data/{filename}.png')
+            if pygame.display.get_surface() is not None:
+                # match the display format, which makes blitting a lot cheaper
+                surface = surface.convert_alpha()
+            self._surfaces[filename] = surface
 
         return self._surfaces[filename]
 
@@ -37,156 +115,352 @@ class Assets():
 
         return self._sounds[filename]
 
+    def surface_bytes(self) -> int:
+        return sum(
+            surface_bytes(surface) for surface in list(self._surfaces.values()) + list(self._transformed.values())
+        )
 
-class Phrase():
-    def __init__(
-            self, duration: float,
-            actor: Optional[str] = None,
-            from_position: Tuple[int, int] = (0,0),
-            to_position: Optional[Tuple[int, int]] = None,
-            easing: Optional[str] = None,
-            color: Optional[str] = None,
-            sound: Optional[str] = None,
-            confetti: Optional[bool] = False
-        ) -> None:
-
-        self.duration: float = duration
-        self.actor: Optional[pygame.Surface] = Assets().get_surface(actor) if actor else None # Optional[pygame.Surface]
-
-        self.from_position: Tuple[int, int] = from_position
-        self.to_position: Tuple[int, int] = to_position if to_position else from_position
-
-        self.easing: Easing = Easing[easing] if easing else Easing.NONE
-
-        self.color: Optional[LampColor] = LampColor[color] if color else None
-        self.sound: Optional[pygame.mixer.Sound] = Assets().get_sound(sound) if sound else None
+    def sound_bytes(self) -> int:
+        mixer_settings = pygame.mixer.get_init()
+        if not mixer_settings:
+            return 0
+        frequency, sample_format, channels = mixer_settings
+        bytes_per_second: int = frequency * channels * abs(sample_format) // 8
+        return sum(int(sound.get_length() * bytes_per_second) for sound in list(self._sounds.values()))
+
+    def get_transformed(self, filename: str, scale: float) -> pygame.Surface:
+        """ An actor scaled by `scale`. Cached, as scaling takes several milliseconds. """
+        if scale == 1:
+            return self.get_surface(filename)
+
+        key: Tuple[str, float] = (filename, scale)
+        surface: Optional[pygame.Surface] = self._transformed.pop(key, None)
+        if surface is None:
+            original: pygame.Surface = self.get_surface(filename)
+            surface = pygame.transform.smoothscale(original, (
+                max(1, int(original.get_width() * scale)), max(1, int(original.get_height() * scale))
+            ))
+            self._transformed_bytes += surface_bytes(surface)
+
+            while self._transformed and self._transformed_bytes > MAX_TRANSFORMED_BYTES:
+                logging.warning(f'Scaled actors exceed {MAX_TRANSFORMED_BYTES} bytes; dropping the least recently used')
+                evicted: pygame.Surface = self._transformed.pop(next(iter(self._transformed)))
+                self._transformed_bytes -= surface_bytes(evicted)
+                self.evictions += 1
+
+        self._transformed[key] = surface
+        return surface
+
+
+class _Segment:
+    """ A stretch of time in which an actor track shows one sprite. """
+    __slots__ = (
+        'start', 'end', 'duration', 'actor', 'surface', 'from_position', 'to_position', 'easing',
+        'from_scale', 'to_scale', 'scales', 'from_alpha', 'to_alpha', 'transformed'
+    )
 
-        self.confetti: Optional[bool] = confetti
+    def __init__(self, start: float, json: Dict[str, Any]) -> None:
+        self.start: float = start
+        self.duration: float = float(json['duration'])
+        # a negative duration holds the segment forever
+        self.end: float = start + self.duration if self.duration >= 0 else math.inf
+
+        self.actor: Optional[str] = json.get('actor')
+        self.surface: Optional[pygame.Surface] = Assets().get_surface(self.actor) if self.actor else None
+
+        self.from_position: Tuple[int, int] = tuple(json['from']) if 'from' in json else (0,0)
+        self.to_position: Tuple[int, int] = tuple(json['to']) if 'to' in json else self.from_position
+
+        self.easing: List[float] = easing_table(json.get('easing'))
+
+        scale = json.get('scale', 1)
+        self.from_scale, self.to_scale = (scale, scale) if not isinstance(scale, list) else scale
+        alpha = json.get('alpha', 255)
+        self.from_alpha, self.to_alpha = (alpha, alpha) if not isinstance(alpha, list) else alpha
+        self.transformed: bool = (self.from_scale, self.to_scale, self.from_alpha, self.to_alpha) != (1, 1, 255, 255)
+
+        # the scales to show, from from_scale to to_scale; rendered now, so
+        # playback only picks the nearest one
+        variants: int = min(MAX_SCALE_VARIANTS, int(round(abs(self.to_scale - self.from_scale) / SCALE_STEP)) + 1)
+        self.scales: List[float] = _scale_variants(self.from_scale, self.to_scale, variants)
+        if self.surface is not None:
+            while variants > 2 and sum(_scaled_bytes(self.surface, scale) for scale in self.scales) > MAX_SEGMENT_BYTES:
+                variants -= 1
+                self.scales = _scale_variants(self.from_scale, self.to_scale, variants)
+        if self.actor:
+            for scale in self.scales:
+                Assets().get_transformed(self.actor, scale)
+
+
+def _scale_variants(from_scale: float, to_scale: float, variants: int) -> List[float]:
+    if variants < 2:
+        return [from_scale]
+    return [from_scale + (to_scale - from_scale) * variant / (variants - 1) for variant in range(variants)]
+
+
+def _scaled_bytes(surface: pygame.Surface, scale: float) -> int:
+    """ The size of a cached variant of `surface`; scale 1 is the surface itself, which is not cached. """
+    if scale == 1:
+        return 0
+    return int(surface.get_width() * scale) * int(surface.get_height() * scale) * surface.get_bytesize()
+
+
+class _Event:
+    """ A change of lamps, a confetti shot or a sound, at a point in time. """
+    __slots__ = ('time', 'color', 'confetti', 'sound')
+
+    def __init__(self, time: float, json: Dict[str, Any]) -> None:
+        self.time: float = time
+        self.color: Optional[LampColor] = LampColor[json['color']] if json.get('color') else None
+        self.confetti: bool = bool(json.get('confetti', False))
+        self.sound: Optional[pygame.mixer.Sound] = Assets().get_sound(json['sound']) if json.get('sound') else None
+
+
+class Timeline():
+    """
+        The animation for a state: any number of actor tracks that play
+        concurrently, plus light and sound events. In animations.json a state
+        is either a list of phrases (one actor, with the lights and sounds
+        starting along with each phrase), or an object:
+
+            {
+                "actors": [
+                    [{"duration": 2, "actor": "closeup_neutral", "from": [220, 1920], "to": [220, 1408],
+                      "easing": "OUT", "scale": [1, 1.5], "alpha": [0, 255]}, ...],
+                    [{"start": 1, "duration": 3, "actor": "dimi_flying", ...}, ...]
+                ],
+                "lights": [{"time": 0, "color": "GREEN"}, {"time": 30, "confetti": true}],
+                "sounds": [{"time": 2, "sound": "violin"}]
+            }
+
+        Segments in an actor track follow each other, unless they have a "start"
+        time. "easing" is an Easing name, a cubic-bezier [x1, y1, x2, y2] or a
+        lookup table {"table": [...]}; "scale" and "alpha" are a value or a
+        [from, to] pair.
+    """
+    def __init__(self, tracks: List[List[_Segment]], events: List[_Event]) -> None:
+        self.tracks: List[List[_Segment]] = tracks
+        self.events: List[_Event] = sorted(events, key=lambda event: event.time)
+
+        # the time after which nothing changes anymore, apart from held segments
+        self.end: float = max(
+            [segment.end if segment.end != math.inf else segment.start for segment in sum(tracks, [])] +
+            [event.time for event in self.events] + [0]
+        )
 
-    def __repr__(self):
-        return f'<Phrase: duration: {self.duration}, actor: {self.actor}>'
+    @classmethod
+    def from_json(cls, json: Any) -> 'Timeline':
+        if isinstance(json, list):
+            return cls._from_phrases(json)
+
+        tracks: List[List[_Segment]] = []
+        for track_json in json.get('actors', []):
+            segments: List[_Segment] = []
+            time: float = 0
+            for segment_json in track_json:
+                segment: _Segment = _Segment(float(segment_json.get('start', time)), segment_json)
+                segments.append(segment)
+                time = segment.end
+            tracks.append(segments)
+
+        events: List[_Event] = [
+            _Event(float(event_json['time']), event_json)
+            for event_json in json.get('lights', []) + json.get('sounds', [])
+        ]
+        return cls(tracks, events)
 
     @classmethod
-    def from_json(cls, json: Dict[str, any]) -> 'Phrase':
-        return cls(
-            duration=json['duration'],
-            actor=json['actor'] if 'actor' in json else None,
-            from_position=tuple(json['from']) if 'from' in json else (0,0),
-            to_position=tuple(json['to']) if 'to' in json else None,
-            easing=json['easing'] if 'easing' in json else None,
-            color=json['color'] if 'color' in json else None,
-            sound=json['sound'] if 'sound' in json else None,
-            confetti=json['confetti'] if 'confetti' in json else False
-        )
+    def _from_phrases(cls, phrases_json: List[Dict[str, Any]]) -> 'Timeline':
+        segments: List[_Segment] = []
+        events: List[_Event] = []
+        time: float = 0
+        for phrase_json in phrases_json:
+            segment: _Segment = _Segment(time, phrase_json)
+            segments.append(segment)
+            if time > 0:
+                # the first phrase only shows its actor; its lamps and sound were never played
+                events.append(_Event(time, phrase_json))
+            time = segment.end
+        return cls([segments], events)
 
 
 class StateAnimationRenderer():
-    def __init__(self, gpio: FirmataGPIO) -> None:
-        self._gpio = gpio
+    def __init__(self, gpio: Optional[FirmataGPIO] = None) -> None:
+        self._gpio: Optional[FirmataGPIO] = gpio
 
         logging.info('Loading state animations...')
 
         with open('data/animations.json') as json_file:
             json_data = json.load(json_file)
 
-        self._phrases: Dict[SpaceState, List[Phrase]] = {}
+        assets: Assets = Assets()
+        evictions: int = assets.evictions
+        self._timelines: Dict[SpaceState, Timeline] = {}
         for state in SpaceState:
-            self._phrases[state] = [
-                Phrase.from_json(phrase_json) for phrase_json in json_data[state.name]
-            ] if state.name in json_data else []
+            self._timelines[state] = Timeline.from_json(json_data[state.name] if state.name in json_data else [])
+        if assets.evictions > evictions:
+            # the scaled actors would be rendered again during playback, which takes too long
+            raise ValueError(
+                f'The scaled actors in animations.json take more than {MAX_TRANSFORMED_BYTES} bytes; '
+                'scale fewer segments or scale them less'
+            )
 
         self._state = SpaceState.UNDETERMINED
-        self._state_start_time: float = 0
-        self._state_color: Optional[LampColor] = None
+        self._state_start_time: float = time.monotonic()
+        self._state_color: Optional[Tuple[int, int, int]] = None
 
-        self._phrase_number: int = 0
-        self._phrase_start: float = time.monotonic()
+        # playback position: the next event, the next event with lamp changes
+        # still to schedule, and the current segment per track
+        self._event_index: int = 0
+        self._light_index: int = 0
+        self._segment_indices: List[int] = [0] * len(self._timelines[self._state].tracks)
 
-        self._hotel_coordinates: Optional[Tuple[int, int]] = None
+        # set_state() may be called from other threads; the state is switched in draw()
+        self._pending_lock: Lock = Lock()
+        self._pending: Optional[Tuple[SpaceState, bool, float]] = None
 
     def stop(self) -> None:
-        self._gpio.close()
+        if self._gpio is not None:
+            self._gpio.close()
 
-    def set_state(self, state: SpaceState) -> None:
-        if state == self._state:
-            return
+    def set_gpio(self, gpio: Optional[FirmataGPIO]) -> None:
+        self._gpio = gpio
+
+    def set_state(self, state: SpaceState, animate: bool = True) -> None:
+        """
+            Args:
+                state (SpaceState): The state to show
+                animate (bool): Whether to play the animation for the state;
+                    if not, skip to its end without firing any of its events
+        """
+        with self._pending_lock:
+            latest_state: SpaceState = self._pending[0] if self._pending is not None else self._state
+            if state == latest_state and animate:
+                return
+            self._pending = (state, animate, time.monotonic())
+
+    def _apply_state(self, state: SpaceState, animate: bool, start_time: float) -> None:
+        # lamp changes of the previous animation that did not happen yet
+        if self._gpio is not None:
+            self._gpio.clear_schedule()
 
         self._state = state
-        self._state_start_time = time.monotonic()
+        self._state_start_time = start_time
         self._state_color = None
-        self._phrase_number = 0
-        self._phrase_start = time.monotonic()
+        self._event_index = 0
+        self._light_index = 0
+        self._segment_indices = [0] * len(self._timelines[state].tracks)
+
+        if not animate:
+            timeline: Timeline = self._timelines[state]
+            self._state_start_time -= timeline.end
+            self._event_index = self._light_index = len(timeline.events)
+            for event in timeline.events:
+                if event.color:
+                    self._state_color = event.color.value
 
     def draw(self, destination: pygame.Surface) -> None:
-        if self._state not in self._phrases:
-            # we don't have anything to do in this state
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = None
+        if pending is not None:
+            self._apply_state(*pending)
+
+        timeline: Timeline = self._timelines[self._state]
+        current_time: float = time.monotonic() - self._state_start_time
+
+        # schedule the lamps a little ahead, then fire the events that are due
+        events: List[_Event] = timeline.events
+        while self._light_index < len(events) and events[self._light_index].time <= current_time + LAMP_LOOKAHEAD:
+            self._schedule_lights(events[self._light_index])
+            self._light_index += 1
+        while self._event_index < len(events) and events[self._event_index].time <= current_time:
+            self._fire(events[self._event_index])
+            self._event_index += 1
+
+        # interpolate all tracks, then draw all actors in one go
+        assets: Assets = Assets()
+        blits: List[Tuple[pygame.Surface, Tuple[int, int]]] = []
+        # surface alpha per surface in blits, by id
+        alphas: Dict[int, int] = {}
+        segment_indices: List[int] = self._segment_indices
+        for track_number, segments in enumerate(timeline.tracks):
+            index: int = segment_indices[track_number]
+            while index < len(segments) and segments[index].end <= current_time:
+                index += 1
+            segment_indices[track_number] = index
+
+            if index >= len(segments):
+                continue
+            segment: _Segment = segments[index]
+            if segment.surface is None or segment.start > current_time:
+                continue
+
+            eased: float = 0
+            if segment.duration > 0:
+                # linear interpolation between the two nearest table entries
+                position: float = (current_time - segment.start) / segment.duration * (EASING_TABLE_SIZE - 1)
+                entry: int = int(position)
+                if entry >= EASING_TABLE_SIZE - 1:
+                    eased = segment.easing[-1]
+                else:
+                    eased = segment.easing[entry] + (segment.easing[entry + 1] - segment.easing[entry]) * (position - entry)
+
+            x: float = segment.from_position[0] + (segment.to_position[0] - segment.from_position[0]) * eased
+            y: float = segment.from_position[1] + (segment.to_position[1] - segment.from_position[1]) * eased
+
+            surface: pygame.Surface = segment.surface
+            alpha: int = 255
+            if segment.transformed:
+                scales: List[float] = segment.scales
+                variant: int = min(len(scales) - 1, max(0, int(0.5 + eased * (len(scales) - 1))))
+                surface = assets.get_transformed(segment.actor, scales[variant])
+                alpha = min(255, max(0, int(0.5 + segment.from_alpha + (segment.to_alpha - segment.from_alpha) * eased)))
+                # scale around the center of the sprite
+                x += (segment.surface.get_width() - surface.get_width()) / 2
+                y += (segment.surface.get_height() - surface.get_height()) / 2
+
+            # the alpha is set on the surface itself, so a surface that is
+            # shown twice with different alphas needs a blits call of its own
+            if alphas.get(id(surface), alpha) != alpha:
+                destination.blits(blits, doreturn=False)
+                blits = []
+                alphas = {}
+            alphas[id(surface)] = alpha
+            if surface.get_alpha() != alpha:
+                surface.set_alpha(alpha)
+
+            blits.append((surface, (int(0.5 + x), int(0.5 + y))))
+
+        if blits:
+            destination.blits(blits, doreturn=False)
+
+    def _schedule_lights(self, event: _Event) -> None:
+        """ Has the gpio output worker switch the lamps and confetti at the time of the event. """
+        if self._gpio is None:
             return
 
-        phrases: List[Phrase] = self._phrases[self._state]
-
-        if self._phrase_number >= len(phrases):
-            # all phrases for this state have been played out
-            return
-
-        phrase: Phrase = phrases[self._phrase_number]
-        current_time: float = time.monotonic()
-
-        if phrase.duration >= 0 and (current_time - self._phrase_start > phrase.duration):
-            self._phrase_number += 1
+        at: float = self._state_start_time + event.time
+        if event.color:
+            self._gpio.set_color(event.color, at)
 
-            if self._phrase_number >= len(phrases):
-                # nothing left to do
-                return
-
-            phrase = phrases[self._phrase_number]
-
-            self._phrase_start = current_time
-            phrase.duration = phrase.duration
-            logging.debug(f'Entering phrase: {self._state.name}.{self._phrase_number}')
-
-            # change the lamps if necessary
-            if phrase.color:
-                self._gpio.set_color(phrase.color)
-
-                self._state_color = phrase.color.value
+        # fire the confetti canons! (if necessary in this event)
+        if event.confetti:
+            self._gpio.fire_confetti(at)
 
-            # play a sound if necessary
-            if phrase.sound:
-                phrase.sound.play()
+    def _fire(self, event: _Event) -> None:
+        logging.debug(f'Animation event at {event.time:.2f}s in {self._state.name}')
 
-            # fire the confetti canons! (if necessary in this phrase)
-            if phrase.confetti:
-                self._gpio.fire_confetti()
+        if event.color:
+            self._state_color = event.color.value
 
-        if self._hotel_coordinates and self._state_color:
-            pygame.draw.circle(
-                destination,
-                self._state_color,
-                self._hotel_coordinates,
-                16
-            )
-
-        if phrase.duration > 0:
-            phrase_progress = (current_time - self._phrase_start) / phrase.duration
-        else:
-            phrase_progress = 0
-
-        # apply easing function
-        if phrase.easing == Easing.IN:
-            phrase_progress = phrase_progress * phrase_progress
-        elif phrase.easing == Easing.OUT:
-            phrase_progress = 1 - (1 - phrase_progress) * (1 - phrase_progress)
-
-        # draw the actor to the destination surface, if an actor is specified
-        if phrase.actor:
-            coordinate = tuple(
-                int(0.5 + (c[0] * (1-phrase_progress)) + (c[1] * phrase_progress))
-                for c in zip (phrase.from_position, phrase.to_position)
-            )
-            destination.blit(phrase.actor, coordinate)
+        # play a sound if necessary
+        if event.sound:
+            event.sound.play()
 
-    def set_hotel_coordinates(self, hotel_coordinates: Tuple[int, int]):
-        self._hotel_coordinates = hotel_coordinates
+    def get_state_color(self) -> Optional[Tuple[int, int, int]]:
+        """ The color the lamps were last set to by the animation, if any. """
+        return self._state_color
 
 
 